@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage benchmark of the myclip backends over batch sizes and thread counts, results are written as JSON.
+"""
+
+import os
+import glob
+import json
+import time
+import argparse
+import platform
+import importlib
+import numpy as np
+import torch
+
+from convert.trt_buffers import OutputBufferPool, get_binding_idxs, output_results
+from myclip.transform import FrameTransform
+from myclip.utils import loadLabels, openImage
+
+
+STAGES = ["decode", "preprocess", "encode_image", "similarity", "topk"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["clip3", "clip3ort", "stub"],
+        choices=["clip1", "clip3", "clip3ort", "clip3trt", "stub"],
+        help="Backends to benchmark. 'stub' replaces the execution of the TensorRT image engine with random features "
+             "(the output buffers still come from the OutputBufferPool used by clip3trt), to measure everything "
+             "around the model without a GPU. The stub has no predict_batch, its throughput is the sum of the stages."
+    )
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--threads", nargs="+", type=int, default=[torch.get_num_threads()],
+                        help="Values for torch.set_num_threads (and intra-op threads of onnxruntime).")
+    parser.add_argument("--images", default="./demo/pokemon.jpeg", type=str,
+                        help="Glob of the images to decode, repeated to fill the batch.")
+    parser.add_argument("--label-csv", default="./labels/val158.csv", type=str)
+    parser.add_argument("--full-decode", action="store_true",
+                        help="Decode JPEGs at full size instead of the smallest DCT-scaled size above the model input.")
+    parser.add_argument("--warmup", default=3, type=int, help="Untimed runs before each measurement.")
+    parser.add_argument("--repeat", default=10, type=int, help="Timed runs of each stage.")
+    parser.add_argument("--k", default=5, type=int, help="k of the top-k stage.")
+    parser.add_argument("--output", default="./benchmark.json", type=str)
+    args = parser.parse_args()
+    return args
+
+
+class StubContext(object):
+    # 代替TensorRT的engine和执行上下文，只实现OutputBufferPool用到的binding接口
+    # binding 0: 输入"image" [N, 3, H, W]，binding 1: 输出"unnorm_image_features" [N, dim]
+    num_bindings = 2
+    num_optimization_profiles = 1
+
+    def __init__(self, dim):
+        self.engine = self
+        self.dim = dim
+        self.batch = 0
+
+    def binding_is_input(self, index):
+        return index == 0
+
+    def get_binding_name(self, index):
+        return ["image", "unnorm_image_features"][index]
+
+    def set_binding_shape(self, index, shape):
+        self.batch = shape[0]
+
+    def get_binding_shape(self, binding):
+        return (self.batch, self.dim)
+
+
+class StubBackend(object):
+    # 和clip3trt相同的接口，输出缓冲区和clip3trt一样由OutputBufferPool复用，只是engine的执行换成随机特征
+    def __init__(self, dim=512):
+        from cn_clip.clip.utils import _MODEL_INFO, image_transform
+        # clip3trt的topk和clip3的相同，clip3trt依赖TensorRT不能在没有GPU时导入
+        from myclip.clip3 import topk
+        self.dim = dim
+        self.topk = topk
+        self.preprocess = image_transform(_MODEL_INFO["ViT-B-16"]['input_resolution'])
+        self.preprocess_frame = FrameTransform(_MODEL_INFO["ViT-B-16"]['input_resolution'])
+        context = StubContext(dim)
+        input_idxs, output_idxs = get_binding_idxs(context, 0)
+        self.output_pool = OutputBufferPool(context, input_idxs, output_idxs, device="cpu")
+
+    def setup(self, labels):
+        text_features = torch.randn(len(labels), self.dim)
+        self.text_features = text_features / text_features.norm(dim=1, keepdim=True)
+
+    def encodeImage(self, image):
+        outputs, _ = self.output_pool.get([image])
+        outputs["unnorm_image_features"].normal_()
+        return output_results(outputs, reuse_outputs=True)["unnorm_image_features"]
+
+
+def loadBackend(name, labels):
+    if name == "stub":
+        backend = StubBackend()
+    else:
+        backend = importlib.import_module(f"myclip.{name}")
+    backend.setup(labels)
+    return backend
+
+
+def setThreads(backend, threads):
+    torch.set_num_threads(threads)
+    # onnxruntime的线程数在创建session时确定
+    if hasattr(backend, "intra_op_num_threads"):
+        backend.intra_op_num_threads = threads
+        backend.loadModel()
+
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def measure(fn, warmup, repeat):
+    for _ in range(warmup):
+        fn()
+    synchronize()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        synchronize()
+        times.append(time.perf_counter() - start)
+    times = np.array(times) * 1000
+    return {
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "min_ms": float(times.min()),
+        "max_ms": float(times.max()),
+    }
+
+
+def benchmarkStages(backend, img_paths, batch_size, args):
+    paths = [img_paths[i % len(img_paths)] for i in range(batch_size)]
+    text_features = backend.text_features
+    use_numpy = isinstance(text_features, np.ndarray)
+
+    size = None if args.full_decode else backend.preprocess_frame.resolution
+
+    def decode():
+        return [openImage(p, size) for p in paths]
+
+    imgs = decode()
+
+    def preprocess():
+        return torch.stack([backend.preprocess(img) for img in imgs])
+
+    images = preprocess()
+
+    def encode_image():
+        with torch.no_grad():
+            return backend.encodeImage(images)
+
+    image_features = encode_image()
+    if not use_numpy:
+        image_features = torch.as_tensor(image_features).to(text_features.dtype)
+
+    def similarity():
+        if use_numpy:
+            normed = image_features / np.linalg.norm(image_features, axis=1, keepdims=True)
+            return 100 * normed @ text_features.T
+        with torch.no_grad():
+            normed = image_features / image_features.norm(dim=1, keepdim=True)
+            return 100 * normed @ text_features.t()
+
+    logits_per_image = similarity()
+    k = min(args.k, len(text_features))
+
+    def topk():
+        # 后端自己的top-k，和predict_batch一样把结果传回主机
+        idxs, probs = backend.topk(logits_per_image, k)
+        return idxs.tolist(), probs.tolist()
+
+    stage_fns = {"decode": decode, "preprocess": preprocess, "encode_image": encode_image,
+                 "similarity": similarity, "topk": topk}
+    stages = {stage: measure(stage_fns[stage], args.warmup, args.repeat) for stage in STAGES}
+
+    # 实际使用的推理路径（TensorRTModel、融合的分类图等），输入是预处理好的batch
+    predict = None
+    if hasattr(backend, "predict_batch"):
+        predict = measure(lambda: backend.predict_batch(images, k), args.warmup, args.repeat)
+    return stages, predict
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Log params.
+    print("Params:")
+    for name in sorted(vars(args)):
+        val = getattr(args, name)
+        print(f"  {name}: {val}")
+
+    labels = loadLabels(args.label_csv)
+    img_paths = sorted(glob.glob(args.images))
+    assert img_paths, f"Error: no image matches --images {args.images}!"
+
+    results = []
+    for backend_name in args.backends:
+        backend = loadBackend(backend_name, labels)
+        for threads in args.threads:
+            setThreads(backend, threads)
+            for batch_size in args.batch_sizes:
+                stages, predict = benchmarkStages(backend, img_paths, batch_size, args)
+                # 吞吐量按 解码 + 预处理 + predict_batch 计算，没有predict_batch时用各阶段之和
+                if predict is not None:
+                    total_ms = stages["decode"]["mean_ms"] + stages["preprocess"]["mean_ms"] + predict["mean_ms"]
+                else:
+                    total_ms = sum(stage["mean_ms"] for stage in stages.values())
+                results.append({
+                    "backend": backend_name,
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    "stages": stages,
+                    "predict_batch": predict,
+                    "total_ms": total_ms,
+                    "images_per_s": batch_size / total_ms * 1000,
+                })
+                print(f"{backend_name}\tthreads={threads}\tbatch={batch_size}\t" +
+                      "\t".join(f"{stage}={stages[stage]['mean_ms']:.2f}ms" for stage in STAGES) +
+                      (f"\tpredict_batch={predict['mean_ms']:.2f}ms" if predict is not None else "") +
+                      f"\t{batch_size / total_ms * 1000:.1f}img/s")
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "cuda": torch.cuda.get_device_name() if torch.cuda.is_available() else None,
+            "warmup": args.warmup,
+            "repeat": args.repeat,
+            "images": img_paths,
+            "full_decode": args.full_decode,
+        },
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f">>> The benchmark results are saved at {args.output}")
@@ -0,0 +1 @@
+# pytest adds the directory of this file (the repository root) to sys.path, tests import myclip/convert from it
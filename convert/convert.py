@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+This script drives the whole Chinese-CLIP conversion (PyTorch -> ONNX FP32 -> ONNX FP16 / optimized ONNX -> TensorRT)
+incrementally.
+A manifest records the content hash of every stage's inputs and outputs together with its arguments,
+stages whose inputs, arguments and outputs are unchanged are skipped, independent stages run in parallel processes.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+CONVERT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model-arch",
+        required=True,
+        choices=["ViT-B-16", "ViT-L-14", "ViT-L-14-336", "ViT-H-14", "RN50"],
+        help="Specify the architecture (model scale) of Chinese-CLIP model to be converted."
+    )
+    parser.add_argument("--pytorch-ckpt-path", default=None, type=str,
+                        help="Path of the input PyTorch Chinese-CLIP checkpoint. Default to None which will automatically download the pretrained checkpoint.")
+    parser.add_argument("--download-root", default=None, type=str,
+                        help="If --pytorch-ckpt-path is None, official pretrained ckpt will be downloaded under --download-root directory.")
+    parser.add_argument("--save-path", required=True, type=str,
+                        help="Path (prefix) of all the converted models, e.g. ./models/vit-b-16 . The manifest is saved at <prefix>.manifest.json .")
+    parser.add_argument("--convert-text", action="store_true", help="Convert the text encoder.")
+    parser.add_argument("--convert-vision", action="store_true", help="Convert the vision encoder.")
+    parser.add_argument("--convert-head", action="store_true",
+                        help="Convert the vision encoder with the classifier head (see pytorch_to_onnx.py --convert-head).")
+    parser.add_argument("--label-csv", default="./labels/2022.csv", type=str, help="Labels baked into the classifier head.")
+    parser.add_argument("--label-col", type=int, default=1, help="Column of --label-csv used as the label text.")
+    parser.add_argument("--top-k", type=int, default=5, help="Number of results returned by the classifier head.")
+    parser.add_argument("--context-length", type=int, default=52,
+                        help="The padded length of input text (include [CLS] & [SEP] tokens). Default to 52.")
+    parser.add_argument("--tensorrt", action="store_true",
+                        help="Also build FP16 TensorRT engines of the converted text/vision encoders.")
+    parser.add_argument('--batch-size', default=1, type=int, help='The optimal batch size of the TensorRT engines.')
+    parser.add_argument('--min-batch-size', default=1, type=int, help='The minimum batch size of the TensorRT engines.')
+    parser.add_argument('--max-batch-size', default=32, type=int, help='The maximum batch size of the TensorRT engines.')
+    parser.add_argument("--optimize", action="store_true",
+                        help="Also save ONNX Runtime optimized FP32 models <prefix>.*.fp32.opt.onnx (see optimize_onnx.py).")
+    parser.add_argument("--jobs", default=2, type=int,
+                        help="Stages running at the same time. Every ONNX export stage loads its own copy of the PyTorch model.")
+    parser.add_argument("--low-memory", action="store_true",
+                        help="Memory-map the checkpoint and convert FP16 initializers one by one (see pytorch_to_onnx.py --low-memory).")
+    parser.add_argument("--force", action="store_true", help="Rerun all the selected stages.")
+    args = parser.parse_args()
+    return args
+
+
+class Stage(object):
+    """
+    One conversion step, rerun when its inputs, outputs or params differ from the manifest.
+    """
+
+    def __init__(self, name, inputs, outputs, params, deps=()):
+        """
+        :param name: <kind>-<tower>, e.g. onnx-vision, fp16-text, opt-head, trt-vision
+        :param inputs: input files, the stage is rerun when their content changes
+        :param outputs: output files, the stage is rerun when they are missing or modified
+        :param params: arguments affecting the outputs
+        :param deps: names of the stages that have to finish first
+        """
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.deps = list(deps)
+
+
+def build_stages(args, ckpt_path):
+    prefix = args.save_path
+    stages = []
+    towers = []
+    if args.convert_text:
+        towers.append(("text", "txt", {"context_length": args.context_length}))
+    if args.convert_vision:
+        towers.append(("vision", "img", {}))
+    if args.convert_head:
+        towers.append(("head", "head", {"context_length": args.context_length, "label_col": args.label_col,
+                                        "top_k": args.top_k}))
+
+    for tower, short, params in towers:
+        fp32_path = f"{prefix}.{short}.fp32.onnx"
+        fp16_path = f"{prefix}.{short}.fp16.onnx"
+        fp32_outputs = [fp32_path]
+        if tower == "vision" and args.model_arch == "ViT-H-14":
+            fp32_outputs.append(f"{fp32_path}.extra_file")
+        inputs = [ckpt_path] + ([args.label_csv] if tower == "head" else [])
+        stages.append(Stage(f"onnx-{tower}", inputs, fp32_outputs, {"model_arch": args.model_arch, **params}))
+        stages.append(Stage(f"fp16-{tower}", fp32_outputs, [fp16_path, f"{fp16_path}.extra_file"], {},
+                            deps=[f"onnx-{tower}"]))
+        if args.optimize:
+            # only the FP32 models are optimized, the fused contrib ops are ONNX Runtime only and
+            # TensorRT keeps using the unoptimized FP16 models
+            opt_path = f"{prefix}.{short}.fp32.opt.onnx"
+            opt_outputs = [opt_path] + ([f"{opt_path}.data"] if len(fp32_outputs) > 1 else [])
+            stages.append(Stage(f"opt-{tower}", fp32_outputs, opt_outputs, {}, deps=[f"onnx-{tower}"]))
+        if args.tensorrt and tower != "head":
+            trt_params = {"model_arch": args.model_arch, "batch_size": args.batch_size,
+                          "min_batch_size": args.min_batch_size, "max_batch_size": args.max_batch_size}
+            if tower == "text":
+                trt_params["context_length"] = args.context_length
+            stages.append(Stage(f"trt-{tower}", [fp16_path, f"{fp16_path}.extra_file"], [f"{prefix}.{short}.fp16.trt"],
+                                trt_params, deps=[f"fp16-{tower}"]))
+    return stages
+
+
+def run_stage(stage, args, ckpt_path):
+    # runs in a worker process, every ONNX export stage loads its own copy of the PyTorch model
+    kind, tower = stage.name.split("-", 1)
+    prefix = args.save_path
+    short = {"text": "txt", "vision": "img", "head": "head"}[tower]
+
+    if kind == "trt":
+        cmd = [sys.executable, os.path.join(CONVERT_DIR, "onnx_to_tensorrt.py"),
+               "--model-arch", args.model_arch, f"--convert-{tower}", f"--{tower}-onnx-path", f"{prefix}.{short}.fp16.onnx",
+               "--save-tensorrt-path", prefix, "--fp16", "--context-length", str(args.context_length),
+               "--batch-size", str(args.batch_size), "--min-batch-size", str(args.min_batch_size),
+               "--max-batch-size", str(args.max_batch_size)]
+        subprocess.run(cmd, check=True)
+        return
+
+    sys.path.insert(0, CONVERT_DIR)
+    import pytorch_to_onnx as p2o
+    if kind == "fp16":
+        p2o.convert_fp16(f"{prefix}.{short}.fp32.onnx", f"{prefix}.{short}.fp16.onnx", args.low_memory)
+        return
+    if kind == "opt":
+        import optimize_onnx
+        optimize_onnx.optimize(f"{prefix}.{short}.fp32.onnx")
+        return
+
+    model, state_dict = p2o.load_pytorch_model(args.model_arch, ckpt_path, args.low_memory)
+    if tower == "text":
+        p2o.export_text(model, prefix, args.context_length)
+    elif tower == "vision":
+        p2o.export_vision(model, args.model_arch, prefix, state_dict)
+    else:
+        p2o.export_head(model, args.model_arch, prefix, args.label_csv, args.label_col, args.top_k, args.context_length)
+
+
+class Manifest(object):
+    """
+    {"files": {path: {size, mtime_ns, sha256}}, "stages": {name: {params, inputs, outputs}}}
+    The recorded hash of a file is reused while its size and modification time are unchanged,
+    so unchanged multi-GB models are not read again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {"files": {}, "stages": {}}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def hash(self, path):
+        if not os.path.isfile(path):
+            return None
+        st = os.stat(path)
+        record = self.data["files"].get(path)
+        if record and record["size"] == st.st_size and record["mtime_ns"] == st.st_mtime_ns:
+            return record["sha256"]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(16 * 1024 * 1024), b''):
+                sha256.update(chunk)
+        self.data["files"][path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256.hexdigest()}
+        return sha256.hexdigest()
+
+    def up_to_date(self, stage):
+        record = self.data["stages"].get(stage.name)
+        if record is None or record["params"] != stage.params:
+            return False
+        if record["inputs"] != {p: self.hash(p) for p in stage.inputs}:
+            return False
+        outputs = {p: self.hash(p) for p in stage.outputs}
+        return None not in outputs.values() and record["outputs"] == outputs
+
+    def record(self, stage):
+        self.data["stages"][stage.name] = {
+            "params": stage.params,
+            "inputs": {p: self.hash(p) for p in stage.inputs},
+            "outputs": {p: self.hash(p) for p in stage.outputs},
+        }
+        self.save()
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Log params.
+    print("Params:")
+    for name in sorted(vars(args)):
+        val = getattr(args, name)
+        print(f"  {name}: {val}")
+
+    assert args.convert_text or args.convert_vision or args.convert_head, \
+        "Error: at least one of --convert-text, --convert-vision and --convert-head is required!"
+
+    sys.path.insert(0, CONVERT_DIR)
+    from pytorch_to_onnx import resolve_checkpoint
+    ckpt_path = resolve_checkpoint(args.model_arch, args.pytorch_ckpt_path, args.download_root)
+
+    manifest = Manifest(f"{args.save_path}.manifest.json")
+    pending = {stage.name: stage for stage in build_stages(args, ckpt_path)}
+    done = set()
+    running = {}
+    skipped = []
+    # spawn: the workers inherit neither the threads nor the modules imported by this process
+    with ProcessPoolExecutor(args.jobs, mp_context=mp.get_context("spawn")) as pool:
+        while pending or running:
+            # stages whose deps are done: skipped if inputs, outputs and params are unchanged, otherwise
+            # submitted once a worker is free, so they start (and are reported and timed) right away
+            for name, stage in list(pending.items()):
+                if not all(dep in done for dep in stage.deps):
+                    continue
+                if not args.force and manifest.up_to_date(stage):
+                    del pending[name]
+                    print(f">>> [{name}] up to date, skipped")
+                    skipped.append(name)
+                    done.add(name)
+                    continue
+                if len(running) >= args.jobs:
+                    continue
+                del pending[name]
+                print(f">>> [{name}] started")
+                running[pool.submit(run_stage, stage, args, ckpt_path)] = (stage, time.perf_counter())
+            if not running:
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, start = running.pop(future)
+                future.result()  # a failed stage raises here and is not recorded in the manifest
+                manifest.record(stage)
+                done.add(stage.name)
+                print(f">>> [{stage.name}] finished in {time.perf_counter() - start:.1f}s")
+
+    print("Finished conversion...")
+    print(f">>> {len(done) - len(skipped)} stages converted, {len(skipped)} stages up to date")
+    print(f">>> The manifest is saved at {manifest.path}")
@@ -41,7 +41,10 @@ def parse_args():
         type=str,
         help="If --convert-vision is True, specify the path of the input vision ONNX model."
     )
-    parser.add_argument('--batch-size', default=1, type=int, help='The batch size of the TensorRT model')
+    parser.add_argument('--batch-size', default=1, type=int, help='The optimal batch size of the TensorRT model')
+    parser.add_argument('--min-batch-size', default=1, type=int, help='The minimum batch size of the TensorRT model')
+    parser.add_argument('--max-batch-size', default=None, type=int,
+                        help='The maximum batch size of the TensorRT model. Default to --batch-size.')
     parser.add_argument(
         "--context-length", type=int, default=52, help="The padded length of input text (include [CLS] & [SEP] tokens)."
     )
@@ -76,20 +79,23 @@ if __name__ == '__main__':
     trt.init_libnvinfer_plugins(trt_logger, '')
 
     # ONNX -> TensorRT
+    min_batch_size = args.min_batch_size
     batch_size = args.batch_size
+    max_batch_size = args.max_batch_size or batch_size
+    assert min_batch_size <= batch_size <= max_batch_size, "Error: --min-batch-size <= --batch-size <= --max-batch-size is required!"
     if args.convert_text:
         seq_len = args.context_length
-        text_input_shape = [TensorRTShape((batch_size, seq_len),
+        text_input_shape = [TensorRTShape((min_batch_size, seq_len),
                                         (batch_size, seq_len),
-                                        (batch_size, seq_len), 'text')]
+                                        (max_batch_size, seq_len), 'text')]
         input_text_onnx_path = args.text_onnx_path
         assert os.path.exists(input_text_onnx_path), f"Error: The specified --text-onnx-path {input_text_onnx_path} not exists!"
     
     if args.convert_vision:
         image_size = _MODEL_INFO[args.model_arch]['input_resolution']
-        vision_input_shape = [TensorRTShape((batch_size, 3, image_size, image_size),
+        vision_input_shape = [TensorRTShape((min_batch_size, 3, image_size, image_size),
                                             (batch_size, 3, image_size, image_size),
-                                            (batch_size, 3, image_size, image_size), 'image')]
+                                            (max_batch_size, 3, image_size, image_size), 'image')]
         input_vision_onnx_path = args.vision_onnx_path
         assert os.path.exists(input_vision_onnx_path), f"Error: The specified --vision-onnx-path {input_vision_onnx_path} not exists!"
 
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+This script optimizes a converted Chinese-CLIP ONNX model offline for ONNX Runtime (constant folding,
+LayerNorm/GELU/attention fusion, redundant Cast removal) and saves it together with an equivalence check
+of its outputs against the original model.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import onnx
+import onnxruntime as ort
+from onnxruntime.transformers.optimizer import optimize_model
+import cn_clip.clip as clip
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--onnx-path", required=True, type=str, help="Path of the input ONNX model (text, vision or classifier head).")
+    parser.add_argument("--save-path", default=None, type=str,
+                        help="Path of the optimized ONNX model. Default to <onnx-path without .onnx>.opt.onnx .")
+    parser.add_argument("--check-batch-size", default=4, type=int, help="Batch size of the random inputs of the equivalence check.")
+    parser.add_argument("--rtol", default=None, type=float,
+                        help="Allowed max abs difference relative to the max abs output. Default to 1e-3 (FP32) or 1e-2 (FP16).")
+    parser.add_argument("--min-cosine", default=None, type=float,
+                        help="Minimum cosine similarity of every output row. Default to 0.9999 (FP32) or 0.999 (FP16).")
+    args = parser.parse_args()
+    return args
+
+
+def default_save_path(onnx_path):
+    return f"{onnx_path[:-len('.onnx')] if onnx_path.endswith('.onnx') else onnx_path}.opt.onnx"
+
+
+def inspect_model(onnx_path):
+    # whether the weights are FP16 and stored as external data, and the metadata
+    model = onnx.load_model(onnx_path, load_external_data=False)
+    fp16 = any(t.data_type == onnx.TensorProto.FLOAT16 for t in model.graph.initializer)
+    external = any(t.data_location == onnx.TensorProto.EXTERNAL for t in model.graph.initializer)
+    return fp16, external, {p.key: p.value for p in model.metadata_props}
+
+
+def random_inputs(session, batch_size):
+    # text: tokenized sample texts, image: a fixed random normal batch
+    inputs = {}
+    for node in session.get_inputs():
+        if node.name == 'text':
+            texts = ["一只猫", "废旧电池", "塑料瓶", "香蕉皮", "金属食品罐", "旧报纸", "过期药品", "玻璃杯"]
+            texts = (texts * batch_size)[:batch_size]
+            inputs['text'] = clip.tokenize(texts, context_length=node.shape[1]).numpy()
+        else:
+            shape = [batch_size] + list(node.shape[1:])
+            inputs[node.name] = np.random.RandomState(0).randn(*shape).astype(np.float32)
+    return inputs
+
+
+def create_session(onnx_path):
+    options = ort.SessionOptions()
+    # compare the saved graphs themselves, not what ONNX Runtime makes of them at load time
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    return ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def check_equivalence(onnx_path, optimized_path, batch_size, rtol, min_cosine):
+    original = create_session(onnx_path)
+    optimized = create_session(optimized_path)
+    inputs = random_inputs(original, batch_size)
+    names = [node.name for node in original.get_outputs()]
+    expected = original.run(names, inputs)
+    actual = optimized.run(names, inputs)
+
+    result = {"batch_size": batch_size, "rtol": rtol, "min_cosine": min_cosine, "outputs": {}, "passed": True}
+    for name, x, y in zip(names, expected, actual):
+        if np.issubdtype(x.dtype, np.integer):
+            # e.g. the top-k indices of the classifier head
+            record = {"match": float((x == y).mean())}
+            passed = record["match"] == 1.0
+        else:
+            x, y = x.astype(np.float64).reshape(len(x), -1), y.astype(np.float64).reshape(len(y), -1)
+            max_abs_diff = float(np.abs(x - y).max())
+            cosine = (x * y).sum(axis=1) / (np.linalg.norm(x, axis=1) * np.linalg.norm(y, axis=1) + 1e-12)
+            record = {"max_abs_diff": max_abs_diff, "max_abs": float(np.abs(x).max()), "min_cosine": float(cosine.min())}
+            passed = max_abs_diff <= rtol * record["max_abs"] + 1e-6 and record["min_cosine"] >= min_cosine
+        record["passed"] = passed
+        result["outputs"][name] = record
+        result["passed"] = result["passed"] and passed
+    return result
+
+
+def optimize(onnx_path, save_path=None, check_batch_size=4, rtol=None, min_cosine=None):
+    save_path = save_path or default_save_path(onnx_path)
+    fp16, external, props = inspect_model(onnx_path)
+    rtol = rtol if rtol is not None else (1e-2 if fp16 else 1e-3)
+    min_cosine = min_cosine if min_cosine is not None else (0.999 if fp16 else 0.9999)
+
+    # the text tower is a BERT (RoBERTa) encoder, the vision tower and the classifier head are CLIP ViT (or ResNet) encoders
+    input_names = [node.name for node in create_session(onnx_path).get_inputs()]
+    model_type = 'bert' if input_names == ['text'] else 'clip'
+
+    # constant folding by ONNX Runtime (basic level, hardware independent), then LayerNorm/GELU/attention fusion
+    optimized = optimize_model(onnx_path, model_type=model_type, num_heads=0, hidden_size=0, opt_level=1, use_gpu=False)
+    # Cast pairs left around the FP16 islands
+    optimized.remove_cascaded_cast_nodes()
+    optimized.remove_useless_cast_nodes()
+    optimized.topological_sort()
+
+    optimized.save_model_to_file(save_path, use_external_data_format=external)
+
+    result = check_equivalence(onnx_path, save_path, check_batch_size, rtol, min_cosine)
+    result.update({
+        "source": os.path.basename(onnx_path),
+        "model_type": model_type,
+        "fused_ops": {k: v for k, v in optimized.get_fused_operator_statistics().items() if v},
+        "onnxruntime": ort.__version__,
+    })
+    if not result["passed"]:
+        os.remove(save_path)
+        raise RuntimeError(f"The optimized model is not equivalent to {onnx_path}: {json.dumps(result['outputs'])}")
+
+    # record the check in the metadata of the optimized model, the original metadata (e.g. head labels) is kept
+    model = onnx.load_model(save_path, load_external_data=False)
+    onnx.helper.set_model_props(model, {**props, 'optimization': json.dumps(result, ensure_ascii=False)})
+    onnx.save_model(model, save_path)
+    return save_path, result
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Log params.
+    print("Params:")
+    for name in sorted(vars(args)):
+        val = getattr(args, name)
+        print(f"  {name}: {val}")
+
+    save_path, result = optimize(args.onnx_path, args.save_path, args.check_batch_size, args.rtol, args.min_cosine)
+
+    print("Finished ONNX optimization...")
+    print(f">>> Fused operators: {result['fused_ops']}")
+    for name, record in result["outputs"].items():
+        print(f">>> Output {name}: {record}")
+    print(f">>> The optimized ONNX model is saved at {save_path}")
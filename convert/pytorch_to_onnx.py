@@ -4,11 +4,16 @@ This script converts PyTorch implemented Chinese-CLIP (text or vision) model to
 """
 
 import os
+import csv
+import json
+import pickle
 import argparse
 from PIL import Image
 import torch
 import torch.onnx
-from onnx import load_model, save_model
+import numpy as np
+from onnx import TensorProto, load_model, save_model, numpy_helper
+from onnx.helper import set_model_props, tensor_dtype_to_np_dtype
 from onnxmltools.utils import convert_float_to_float16
 import cn_clip.clip as clip
 from cn_clip.clip.utils import _MODELS, _MODEL_INFO, _download, available_models, create_model, image_transform
@@ -49,14 +54,67 @@ def parse_args():
         action="store_true",
         help="Whether to convert the vision encoder (vision feature extractor) into ONNX."
     )
+    parser.add_argument(
+        "--convert-head",
+        action="store_true",
+        help="Whether to convert the vision encoder together with the classifier head (normalization, similarity against the label embeddings and top-k) into one ONNX graph."
+    )
+    parser.add_argument(
+        "--label-csv", default="./labels/2022.csv", type=str, help="Labels baked into the classifier head. Default to ./labels/2022.csv ."
+    )
+    parser.add_argument(
+        "--label-col", type=int, default=1, help="Column of --label-csv used as the label text. Default to 1 (Chinese name)."
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=5, help="Number of (index, probability) pairs returned by the classifier head. Default to 5."
+    )
     parser.add_argument(
         "--context-length", type=int, default=52, help="The padded length of input text (include [CLS] & [SEP] tokens). Default to 52."
     )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Memory-map the checkpoint instead of reading it, and convert FP16 ONNX initializers one by one straight to the extra file. "
+             "Note that FP32 graphs under 2GB (e.g. ViT-B/L) are exported as a single file which is still parsed as a whole, "
+             "so the peak memory is only bounded for models whose FP32 weights are stored in external data (ViT-H-14)."
+    )
     args = parser.parse_args()
     return args
 
 
-def packing_small_onnx_files(onnx_path):
+class ClassifierHead(torch.nn.Module):
+    # image -> (top-k probs, top-k indices), the label embeddings are a constant of the graph
+    def __init__(self, model, text_features, k):
+        super().__init__()
+        self.model = model
+        self.register_buffer('text_features', text_features)
+        self.k = k
+
+    def forward(self, image):
+        image_features = self.model.encode_image(image)
+        image_features = image_features / image_features.norm(dim=1, keepdim=True)
+        logits_per_image = self.model.logit_scale.exp() * image_features @ self.text_features.t()
+        return logits_per_image.softmax(dim=-1).topk(self.k, dim=-1)
+
+
+def encode_label_texts(model, texts, context_length, batch_size=64):
+    text_features = []
+    with torch.no_grad():
+        for start in range(0, len(texts), batch_size):
+            text = clip.tokenize(texts[start:start + batch_size], context_length=context_length)
+            text_feature = model.encode_text(text)
+            text_features.append(text_feature / text_feature.norm(dim=1, keepdim=True))
+    return torch.cat(text_features)
+
+
+def set_head_props(onnx_path, props):
+    # metadata only, the (external) weights are kept as they are
+    onnx_model = load_model(onnx_path, load_external_data=False)
+    set_model_props(onnx_model, props)
+    save_model(onnx_model, onnx_path)
+
+
+def packing_small_onnx_files(onnx_path, state_dict):
     # packing small files into an extra file
     save_model(load_model(onnx_path), 
             onnx_path, 
@@ -67,7 +125,7 @@ def packing_small_onnx_files(onnx_path):
             convert_attribute=True)
     # remove small files
     onnx_dir = os.path.split(onnx_path)[0]
-    for key in checkpoint['state_dict']:
+    for key in state_dict:
         if key.startswith('module.visual'):
             small_file_path = os.path.join(onnx_dir, key[7:])
             if os.path.exists(small_file_path):
@@ -79,6 +137,217 @@ def packing_small_onnx_files(onnx_path):
     os.system("rm -f {}".format(os.path.join(onnx_dir, "Constant_*_attr__value")))
 
 
+def resolve_checkpoint(model_arch, pytorch_ckpt_path, download_root):
+    # prepare the PyTorch model weights
+    if pytorch_ckpt_path and os.path.isfile(pytorch_ckpt_path):
+        return pytorch_ckpt_path
+    elif model_arch in _MODELS:
+        return _download(_MODELS[model_arch], download_root or os.path.expanduser("./cache/clip"))
+    else:
+        raise RuntimeError(f"Model {model_arch} not found; available models = {available_models()}")
+
+
+def load_pytorch_model(model_arch, input_ckpt_path, low_memory=False):
+    if low_memory:
+        try:
+            model, state_dict = load_pytorch_model_mmap(model_arch, input_ckpt_path)
+            print(f"Memory-mapped {input_ckpt_path} (low-memory loading)")
+            return model, state_dict
+        except (TypeError, RuntimeError, pickle.UnpicklingError) as e:
+            # torch < 2.1, a checkpoint not in the zipfile format,
+            # or non-tensor objects (e.g. training args) rejected by weights_only=True
+            reason = str(e).strip().splitlines()[0] if str(e).strip() else ""
+            print(f"Cannot memory-map {input_ckpt_path} ({type(e).__name__}: {reason}), loading it fully...")
+
+    with open(input_ckpt_path, 'rb') as opened_file:
+        try:
+            # torch >= 2.6 defaults to weights_only=True, training checkpoints also contain non-tensor objects
+            checkpoint = torch.load(opened_file, map_location="cpu", weights_only=False)
+        except TypeError:
+            # torch < 1.13 has no weights_only
+            opened_file.seek(0)
+            checkpoint = torch.load(opened_file, map_location="cpu")
+
+    # prepare the PyTorch implemented model and restore weights
+    model = create_model(_MODEL_INFO[model_arch]['struct'], checkpoint).float().eval()
+    return model, checkpoint['state_dict']
+
+
+def load_pytorch_model_mmap(model_arch, input_ckpt_path):
+    # the weights stay in the memory-mapped checkpoint (page cache) and the model is built on the meta device,
+    # so neither the whole checkpoint nor randomly initialized weights are held in memory
+    checkpoint = torch.load(input_ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+    state_dict = checkpoint['state_dict']
+    if next(iter(state_dict)).startswith('module'):
+        state_dict = {k[len('module.'):]: v for k, v in state_dict.items() if "bert.pooler" not in k}
+    with torch.device("meta"):
+        model = create_model(_MODEL_INFO[model_arch]['struct'])
+    model.load_state_dict(state_dict, assign=True)
+    return model.float().eval(), state_dict
+
+
+# prepare empty image and text as input placeholders for ONNX
+def dummy_image(model_arch):
+    resolution = _MODEL_INFO[model_arch]['input_resolution']
+    preprocess = image_transform(resolution)
+    return preprocess(Image.new('RGB', (resolution, resolution))).unsqueeze(0)
+
+
+def dummy_text(context_length):
+    return clip.tokenize([""], context_length=context_length)
+
+
+def export_text(model, save_onnx_path, context_length):
+    # convert text FP32 ONNX model
+    text = dummy_text(context_length)
+    text_fp32_onnx_path = f"{save_onnx_path}.txt.fp32.onnx"
+    torch.onnx.export(model,
+                (None, text),
+                text_fp32_onnx_path,
+                input_names=['text'],
+                output_names=['unnorm_text_features'],
+                dynamic_axes={'text': {0: 'batch_size'}, 'unnorm_text_features': {0: 'batch_size'}},
+                export_params=True,
+                opset_version=13,
+                verbose=True)
+    return text_fp32_onnx_path
+
+
+def export_vision(model, model_arch, save_onnx_path, state_dict):
+    # convert vision FP32 ONNX model, returns the path and whether it has an extra file
+    image = dummy_image(model_arch)
+    vision_fp32_onnx_path = f"{save_onnx_path}.img.fp32.onnx"
+    vision_fp32_onnx_hasextra = False
+    torch.onnx.export(model,
+                (image, None),
+                vision_fp32_onnx_path,
+                input_names=['image'],
+                output_names=['unnorm_image_features'],
+                dynamic_axes={'image': {0: 'batch_size'}, 'unnorm_image_features': {0: 'batch_size'}},
+                export_params=True,
+                do_constant_folding=False,
+                opset_version=13,
+                verbose=True)
+    # for ViT-H-14 FP32 model, make another conversion to deal with the generated small files
+    if model_arch == "ViT-H-14":
+        packing_small_onnx_files(vision_fp32_onnx_path, state_dict)
+        vision_fp32_onnx_hasextra = True
+    return vision_fp32_onnx_path, vision_fp32_onnx_hasextra
+
+
+def read_label_texts(label_csv, label_col):
+    with open(label_csv, 'r', encoding='gbk') as f:
+        return [row[label_col] for row in csv.reader(f) if row]
+
+
+def export_head(model, model_arch, save_onnx_path, label_csv, label_col, top_k, context_length):
+    # the label texts are stored in the metadata, runtimes use the head only if their labels are the same
+    image = dummy_image(model_arch)
+    texts = read_label_texts(label_csv, label_col)
+    text_features = encode_label_texts(model, texts, context_length)
+    head = ClassifierHead(model, text_features, min(top_k, len(texts))).eval()
+    head_props = {'labels': json.dumps(texts, ensure_ascii=False), 'top_k': str(head.k)}
+
+    # convert classifier head FP32 ONNX model
+    head_fp32_onnx_path = f"{save_onnx_path}.head.fp32.onnx"
+    torch.onnx.export(head,
+                (image,),
+                head_fp32_onnx_path,
+                input_names=['image'],
+                output_names=['probs', 'idxs'],
+                dynamic_axes={'image': {0: 'batch_size'}, 'probs': {0: 'batch_size'}, 'idxs': {0: 'batch_size'}},
+                export_params=True,
+                do_constant_folding=False,
+                opset_version=13,
+                verbose=True)
+    set_head_props(head_fp32_onnx_path, head_props)
+    return head_fp32_onnx_path, len(texts), head.k
+
+
+def read_initializer(tensor, onnx_dir):
+    # the data of an initializer, external data is read from its own file without loading the others
+    if tensor.data_location != TensorProto.EXTERNAL:
+        return numpy_helper.to_array(tensor)
+    info = {entry.key: entry.value for entry in tensor.external_data}
+    dtype = np.dtype(tensor_dtype_to_np_dtype(tensor.data_type))
+    count = int(info['length']) // dtype.itemsize if 'length' in info else -1
+    array = np.fromfile(os.path.join(onnx_dir, info['location']), dtype=dtype, count=count, offset=int(info.get('offset', 0)))
+    return array.reshape(tuple(tensor.dims))
+
+
+def convert_fp16_streaming(fp32_onnx_path, fp16_onnx_path, size_threshold=1024):
+    # the graph is loaded without the external data, every initializer is read, converted and appended to the
+    # extra file one by one, so only the graph and one tensor are held in memory
+    from onnxconverter_common.float16 import DEFAULT_OP_BLOCK_LIST, convert_np_to_float16, convert_float_to_float16
+    fp32_onnx_dir = os.path.dirname(os.path.abspath(fp32_onnx_path))
+    location = "{}.extra_file".format(os.path.split(fp16_onnx_path)[1])
+    model = load_model(fp32_onnx_path, load_external_data=False)
+
+    # same rule as convert_float_to_float16: an initializer is converted if any op outside the block list uses it
+    fp16_inputs = {name for node in model.graph.node if node.op_type not in DEFAULT_OP_BLOCK_LIST for name in node.input}
+
+    with open(os.path.join(os.path.dirname(os.path.abspath(fp16_onnx_path)), location), 'wb') as f:
+        for tensor in model.graph.initializer:
+            array = read_initializer(tensor, fp32_onnx_dir)
+            if tensor.data_type == TensorProto.FLOAT and tensor.name in fp16_inputs:
+                # the same clamping and casting as convert_float_to_float16, 0-d scalars (e.g. logit_scale) are
+                # flattened since numpy 2 rejects them in convert_np_to_float16
+                array = convert_np_to_float16(array.reshape(-1)).reshape(array.shape)
+                tensor.data_type = TensorProto.FLOAT16
+            data = np.ascontiguousarray(array).tobytes()
+
+            for field in ('raw_data', 'float_data', 'int32_data', 'int64_data', 'double_data', 'uint64_data', 'string_data'):
+                tensor.ClearField(field)
+            del tensor.external_data[:]
+            if len(data) < size_threshold:
+                tensor.data_location = TensorProto.DEFAULT
+                tensor.raw_data = data
+                continue
+            tensor.data_location = TensorProto.EXTERNAL
+            for key, value in (('location', location), ('offset', str(f.tell())), ('length', str(len(data)))):
+                entry = tensor.external_data.add()
+                entry.key, entry.value = key, value
+            f.write(data)
+
+    # casts to the weight dtype in the graph (e.g. `x.type(self.conv1.weight.dtype)`) have to follow the
+    # initializers, onnxconverter-common >= 1.14 leaves their target type as it is
+    for node in model.graph.node:
+        if node.op_type == 'Cast':
+            for attr in node.attribute:
+                if attr.name == 'to' and attr.i == TensorProto.FLOAT:
+                    attr.i = TensorProto.FLOAT16
+
+    # the initializers are FP16 now, the converter only rewrites the nodes, inputs/outputs and constants;
+    # check_fp16_ready=False since it would reject the model as already converted, and the shapes are inferred
+    # (on the graph only, the external data is not read) so casts around the blocked ops (e.g. TopK) are typed
+    props = {p.key: p.value for p in model.metadata_props}
+    model = convert_float_to_float16(model, keep_io_types=True, disable_shape_infer=False, check_fp16_ready=False)
+    if props:
+        set_model_props(model, props)
+    save_model(model, fp16_onnx_path)
+    return fp16_onnx_path
+
+
+def convert_fp16(fp32_onnx_path, fp16_onnx_path, low_memory=False):
+    if low_memory:
+        return convert_fp16_streaming(fp32_onnx_path, fp16_onnx_path)
+
+    # convert FP16 ONNX model based on the FP32 model, the metadata (e.g. of the classifier head) is kept
+    fp32_onnx_model = load_model(fp32_onnx_path)
+    props = {p.key: p.value for p in fp32_onnx_model.metadata_props}
+    fp16_onnx_model = convert_float_to_float16(fp32_onnx_model, keep_io_types=True, disable_shape_infer=True)
+    if props:
+        set_model_props(fp16_onnx_model, props)
+    save_model(fp16_onnx_model,
+                fp16_onnx_path,
+                location="{}.extra_file".format(os.path.split(fp16_onnx_path)[1]),
+                save_as_external_data=True,
+                all_tensors_to_one_file=True,
+                size_threshold=1024,
+                convert_attribute=True)
+    return fp16_onnx_path
+
+
 if __name__ == '__main__':
     args = parse_args()
 
@@ -88,78 +357,22 @@ if __name__ == '__main__':
         val = getattr(args, name)
         print(f"  {name}: {val}")
 
-    # prepare the PyTorch model weights
-    if os.path.isfile(args.pytorch_ckpt_path):
-        input_ckpt_path = args.pytorch_ckpt_path
-    elif args.model_arch in _MODELS:
-        input_ckpt_path = _download(_MODELS[args.model_arch], args.download_root or os.path.expanduser("./cache/clip"))
-    else:
-        raise RuntimeError(f"Model {args.model_arch} not found; available models = {available_models()}")
-
-    with open(input_ckpt_path, 'rb') as opened_file:
-        checkpoint = torch.load(opened_file, map_location="cpu")
-
-    # prepare the PyTorch implemented model and restore weights
-    model = create_model(_MODEL_INFO[args.model_arch]['struct'], checkpoint).float().eval()
-
-    # prepare empty image and text as input placeholders for ONNX
-    resolution = _MODEL_INFO[args.model_arch]['input_resolution']
-    preprocess = image_transform(resolution)
-    image = preprocess(Image.new('RGB', (resolution, resolution))).unsqueeze(0)
-    text = clip.tokenize([""], context_length=args.context_length)
+    input_ckpt_path = resolve_checkpoint(args.model_arch, args.pytorch_ckpt_path, args.download_root)
+    model, state_dict = load_pytorch_model(args.model_arch, input_ckpt_path, args.low_memory)
 
     # perform conversions, ONNX text and vision encoders will be saved into separated files
     if args.convert_text:
-        # convert text FP32 ONNX model
-        text_fp32_onnx_path = f"{args.save_onnx_path}.txt.fp32.onnx"
-        torch.onnx.export(model,
-                    (None, text),
-                    text_fp32_onnx_path,
-                    input_names=['text'],
-                    output_names=['unnorm_text_features'],
-                    export_params=True,
-                    opset_version=13,
-                    verbose=True)
-        # convert text FP16 ONNX model based on the FP32 model
-        text_fp16_onnx_path = f"{args.save_onnx_path}.txt.fp16.onnx"
-        text_fp32_onnx_model = load_model(text_fp32_onnx_path)
-        text_fp16_onnx_model = convert_float_to_float16(text_fp32_onnx_model, keep_io_types=True, disable_shape_infer=True)
-        save_model(text_fp16_onnx_model,
-                    text_fp16_onnx_path,
-                    location="{}.extra_file".format(os.path.split(text_fp16_onnx_path)[1]),
-                    save_as_external_data=True,
-                    all_tensors_to_one_file=True,
-                    size_threshold=1024,
-                    convert_attribute=True)
+        text_fp32_onnx_path = export_text(model, args.save_onnx_path, args.context_length)
+        text_fp16_onnx_path = convert_fp16(text_fp32_onnx_path, f"{args.save_onnx_path}.txt.fp16.onnx", args.low_memory)
 
     if args.convert_vision:
-        # convert vision FP32 ONNX model
-        vision_fp32_onnx_path = f"{args.save_onnx_path}.img.fp32.onnx"
-        vision_fp32_onnx_hasextra = False
-        torch.onnx.export(model,
-                    (image, None),
-                    vision_fp32_onnx_path,
-                    input_names=['image'],
-                    output_names=['unnorm_image_features'],
-                    export_params=True,
-                    do_constant_folding=False,
-                    opset_version=13,
-                    verbose=True)
-        # for ViT-H-14 FP32 model, make another conversion to deal with the generated small files
-        if args.model_arch == "ViT-H-14":
-            packing_small_onnx_files(vision_fp32_onnx_path)
-            vision_fp32_onnx_hasextra = True
-        # convert vision FP16 ONNX model based on the FP32 model
-        vision_fp16_onnx_path = f"{args.save_onnx_path}.img.fp16.onnx"
-        vision_fp32_onnx_model = load_model(vision_fp32_onnx_path)
-        vision_fp16_onnx_model = convert_float_to_float16(vision_fp32_onnx_model, keep_io_types=True, disable_shape_infer=True)
-        save_model(vision_fp16_onnx_model,
-                    vision_fp16_onnx_path,
-                    location="{}.extra_file".format(os.path.split(vision_fp16_onnx_path)[1]),
-                    save_as_external_data=True,
-                    all_tensors_to_one_file=True,
-                    size_threshold=1024,
-                    convert_attribute=True)
+        vision_fp32_onnx_path, vision_fp32_onnx_hasextra = export_vision(model, args.model_arch, args.save_onnx_path, state_dict)
+        vision_fp16_onnx_path = convert_fp16(vision_fp32_onnx_path, f"{args.save_onnx_path}.img.fp16.onnx", args.low_memory)
+
+    if args.convert_head:
+        head_fp32_onnx_path, num_labels, head_k = export_head(model, args.model_arch, args.save_onnx_path, args.label_csv,
+                                                              args.label_col, args.top_k, args.context_length)
+        head_fp16_onnx_path = convert_fp16(head_fp32_onnx_path, f"{args.save_onnx_path}.head.fp16.onnx", args.low_memory)
 
     print("Finished PyTorch to ONNX conversion...")
     if args.convert_text:
@@ -168,4 +381,7 @@ if __name__ == '__main__':
     if args.convert_vision:
         print(f">>> The vision FP32 ONNX model is saved at {vision_fp32_onnx_path}" + \
             (f" with extra file {vision_fp32_onnx_path}.extra_file" if vision_fp32_onnx_hasextra else ""))
-        print(f">>> The vision FP16 ONNX model is saved at {vision_fp16_onnx_path} with extra file {vision_fp16_onnx_path}.extra_file")
\ No newline at end of file
+        print(f">>> The vision FP16 ONNX model is saved at {vision_fp16_onnx_path} with extra file {vision_fp16_onnx_path}.extra_file")
+    if args.convert_head:
+        print(f">>> The classifier head FP32 ONNX model ({num_labels} labels, top-{head_k}) is saved at {head_fp32_onnx_path}")
+        print(f">>> The classifier head FP16 ONNX model is saved at {head_fp16_onnx_path} with extra file {head_fp16_onnx_path}.extra_file")
@@ -3,13 +3,19 @@ import os
 from time import time
 import dataclasses
 from dataclasses import dataclass
-from typing import Callable, Dict, List, Optional
+from typing import Callable, List, Optional
 import torch
 
 import tensorrt as trt
 from tensorrt import ICudaEngine, ILayer, INetworkDefinition, Logger, Runtime
 from tensorrt.tensorrt import Builder, IBuilderConfig, IElementWiseLayer, IOptimizationProfile, IReduceLayer
 
+# binding/buffer helpers don't need TensorRT, they live in their own module to be testable without a GPU
+try:
+    from .trt_buffers import OutputBufferPool, get_binding_idxs, get_output_tensors, output_results
+except ImportError:  # imported as a top-level module from the convert directory
+    from trt_buffers import OutputBufferPool, get_binding_idxs, get_output_tensors, output_results
+
 
 @dataclass
 class TensorRTShape:
@@ -241,58 +247,13 @@ def track_infer_time(buffer: List[int]) -> None:
 TRT_LOGGER = trt.Logger()
 
 
-def get_binding_idxs(engine: trt.ICudaEngine, profile_index: int):
-    """
-    Calculate start/end binding indices for current context's profile
-    https://docs.nvidia.com/deeplearning/tensorrt/developer-guide/index.html#opt_profiles_bindings
-    :param engine: TensorRT engine generated during the model building
-    :param profile_index: profile to use (several profiles can be set during building)
-    :return: input and output tensor indexes
-    """
-    num_bindings_per_profile = engine.num_bindings // engine.num_optimization_profiles
-    start_binding = profile_index * num_bindings_per_profile
-    end_binding = start_binding + num_bindings_per_profile  # Separate input and output binding indices for convenience
-    input_binding_idxs: List[int] = []
-    output_binding_idxs: List[int] = []
-    for binding_index in range(start_binding, end_binding):
-        if engine.binding_is_input(binding_index):
-            input_binding_idxs.append(binding_index)
-        else:
-            output_binding_idxs.append(binding_index)
-    return input_binding_idxs, output_binding_idxs
-
-
-def get_output_tensors(
-    context: trt.IExecutionContext,
-    host_inputs: List[torch.Tensor],
-    input_binding_idxs: List[int],
-    output_binding_idxs: List[int],
-):
-    """
-    Reserve memory in GPU for input and output tensors.
-    :param context: TensorRT context shared accross inference steps
-    :param host_inputs: input tensor
-    :param input_binding_idxs: indexes of each input vector (should be the same than during building)
-    :param output_binding_idxs: indexes of each output vector (should be the same than during building)
-    :return: tensors where output will be stored
-    """
-    # explicitly set dynamic input shapes, so dynamic output shapes can be computed internally
-    for host_input, binding_index in zip(host_inputs, input_binding_idxs):
-        input_name = context.engine.get_binding_name(binding_index)
-        context.set_binding_shape(binding_index, tuple(host_input.shape))
-    # assert context.all_binding_shapes_specified
-    device_outputs: Dict[str, torch.Tensor] = dict()
-    for binding_index in output_binding_idxs:
-        # TensorRT computes output shape based on input shape provided above
-        output_shape = context.get_binding_shape(binding=binding_index)
-        output_name = context.engine.get_binding_name(index=binding_index)
-        # allocate buffers to hold output results
-        device_outputs[output_name] = torch.empty(tuple(output_shape), device="cuda")
-    return device_outputs
-
-
 class TensorRTModel(object):
-    def __init__(self, engine_path):
+    def __init__(self, engine_path, reuse_outputs=False):
+        """
+        :param engine_path: path of the serialized TensorRT engine
+        :param reuse_outputs: return views into the pooled output buffers instead of copies.
+            The returned tensors are overwritten by the next call with the same input shape.
+        """
         print(f'load engine_path is {engine_path}')
         self.engine = self.load_engine(engine_path)
         profile_index = 0
@@ -301,6 +262,10 @@ class TensorRTModel(object):
             profile_index=profile_index, stream_handle=torch.cuda.current_stream().cuda_stream
         )
         self.input_binding_idxs, self.output_binding_idxs = get_binding_idxs(self.engine, profile_index)
+        # binding names don't change, query them once instead of on every call
+        self.input_names = [self.engine.get_binding_name(i) for i in self.input_binding_idxs]
+        self.output_pool = OutputBufferPool(self.context, self.input_binding_idxs, self.output_binding_idxs)
+        self.reuse_outputs = reuse_outputs
 
     def load_engine(self, engine_file_path):
         assert os.path.exists(engine_file_path)
@@ -310,10 +275,7 @@ class TensorRTModel(object):
 
     def __call__(self, inputs, time_buffer=None):
         input_tensors: List[torch.Tensor] = list()
-        for i in range(self.context.engine.num_bindings):
-            if not self.context.engine.binding_is_input(index=i):
-                continue
-            tensor_name = self.context.engine.get_binding_name(i)
+        for tensor_name in self.input_names:
             assert tensor_name in inputs, f"input not provided: {tensor_name}"
             tensor = inputs[tensor_name]
             assert isinstance(tensor, torch.Tensor), f"unexpected tensor class: {type(tensor)}"
@@ -324,11 +286,9 @@ class TensorRTModel(object):
                 tensor = tensor.type(torch.int32)
             input_tensors.append(tensor)
 
-        # calculate input shape, bind it, allocate GPU memory for the output
-        outputs: Dict[str, torch.Tensor] = get_output_tensors(
-            self.context, input_tensors, self.input_binding_idxs, self.output_binding_idxs
-        )
-        bindings = [int(i.data_ptr()) for i in input_tensors + list(outputs.values())]
+        # bind input shape, reuse (or allocate on first use of this shape) GPU memory for the output
+        outputs, output_ptrs = self.output_pool.get(input_tensors)
+        bindings = [int(i.data_ptr()) for i in input_tensors] + output_ptrs
         if time_buffer is None:
             self.context.execute_v2(bindings=bindings)
         else:
@@ -337,4 +297,4 @@ class TensorRTModel(object):
 
         torch.cuda.current_stream().synchronize()  # sync all CUDA ops
 
-        return outputs
\ No newline at end of file
+        return output_results(outputs, self.reuse_outputs)
\ No newline at end of file
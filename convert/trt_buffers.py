@@ -0,0 +1,127 @@
+"""
+Binding metadata and output buffer management of TensorRT execution contexts.
+Only the binding API of the engine/context is used and TensorRT is not imported,
+so the caching logic can be tested against a stub engine/context on CPU.
+"""
+from collections import OrderedDict
+from typing import Dict, List
+import torch
+
+
+def get_binding_idxs(engine, profile_index: int):
+    """
+    Calculate start/end binding indices for current context's profile
+    https://docs.nvidia.com/deeplearning/tensorrt/developer-guide/index.html#opt_profiles_bindings
+    :param engine: TensorRT engine generated during the model building
+    :param profile_index: profile to use (several profiles can be set during building)
+    :return: input and output tensor indexes
+    """
+    num_bindings_per_profile = engine.num_bindings // engine.num_optimization_profiles
+    start_binding = profile_index * num_bindings_per_profile
+    end_binding = start_binding + num_bindings_per_profile  # Separate input and output binding indices for convenience
+    input_binding_idxs: List[int] = []
+    output_binding_idxs: List[int] = []
+    for binding_index in range(start_binding, end_binding):
+        if engine.binding_is_input(binding_index):
+            input_binding_idxs.append(binding_index)
+        else:
+            output_binding_idxs.append(binding_index)
+    return input_binding_idxs, output_binding_idxs
+
+
+def get_output_tensors(
+    context,
+    host_inputs: List[torch.Tensor],
+    input_binding_idxs: List[int],
+    output_binding_idxs: List[int],
+    device: str = "cuda",
+):
+    """
+    Reserve memory in GPU for input and output tensors.
+    :param context: TensorRT context shared accross inference steps
+    :param host_inputs: input tensor
+    :param input_binding_idxs: indexes of each input vector (should be the same than during building)
+    :param output_binding_idxs: indexes of each output vector (should be the same than during building)
+    :param device: device where output tensors are allocated
+    :return: tensors where output will be stored
+    """
+    # explicitly set dynamic input shapes, so dynamic output shapes can be computed internally
+    for host_input, binding_index in zip(host_inputs, input_binding_idxs):
+        input_name = context.engine.get_binding_name(binding_index)
+        context.set_binding_shape(binding_index, tuple(host_input.shape))
+    # assert context.all_binding_shapes_specified
+    device_outputs: Dict[str, torch.Tensor] = dict()
+    for binding_index in output_binding_idxs:
+        # TensorRT computes output shape based on input shape provided above
+        output_shape = context.get_binding_shape(binding=binding_index)
+        output_name = context.engine.get_binding_name(index=binding_index)
+        # allocate buffers to hold output results
+        device_outputs[output_name] = torch.empty(tuple(output_shape), device=device)
+    return device_outputs
+
+
+class OutputBufferPool(object):
+    """
+    Keep output buffers (and their binding pointers) per input shape, so that steady-state inference with
+    already seen shapes neither allocates memory nor resets the binding shapes of the context.
+    Only the binding API of the context/engine is used, a stub context can be provided for testing on CPU.
+    """
+
+    def __init__(
+        self,
+        context,
+        input_binding_idxs: List[int],
+        output_binding_idxs: List[int],
+        device: str = "cuda",
+        max_shapes: int = 8,
+    ):
+        """
+        :param context: TensorRT context shared accross inference steps
+        :param input_binding_idxs: indexes of each input vector
+        :param output_binding_idxs: indexes of each output vector
+        :param device: device where output tensors are allocated
+        :param max_shapes: number of distinct input shapes to keep buffers for, least recently used are dropped
+        """
+        self.context = context
+        self.input_binding_idxs = input_binding_idxs
+        self.output_binding_idxs = output_binding_idxs
+        self.device = device
+        self.max_shapes = max_shapes
+        self.buffers: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.bound_shapes = None
+
+    def get(self, host_inputs: List[torch.Tensor]):
+        """
+        Get the output buffers for the given inputs, allocating them on first use of an input shape.
+        :param host_inputs: input tensors, in binding order
+        :return: tensors where output will be stored, and their data pointers in binding order
+        """
+        shapes = tuple(tuple(host_input.shape) for host_input in host_inputs)
+        if shapes in self.buffers:
+            self.buffers.move_to_end(shapes)
+            if shapes != self.bound_shapes:
+                # binding shapes are a state of the context, only set them again when input shapes change
+                for host_input, binding_index in zip(host_inputs, self.input_binding_idxs):
+                    self.context.set_binding_shape(binding_index, tuple(host_input.shape))
+        else:
+            outputs = get_output_tensors(
+                self.context, host_inputs, self.input_binding_idxs, self.output_binding_idxs, self.device
+            )
+            self.buffers[shapes] = (outputs, [int(i.data_ptr()) for i in outputs.values()])
+            if len(self.buffers) > self.max_shapes:
+                self.buffers.popitem(last=False)
+        self.bound_shapes = shapes
+        return self.buffers[shapes]
+
+
+def output_results(outputs: Dict[str, torch.Tensor], reuse_outputs: bool) -> Dict[str, torch.Tensor]:
+    """
+    Results returned to the caller of an inference step.
+    :param outputs: pooled output buffers
+    :param reuse_outputs: return the pooled buffers themselves (overwritten by the next call with the same
+        input shape) instead of copies
+    :return: output tensors by name
+    """
+    if reuse_outputs:
+        return dict(outputs)
+    return {name: output.clone() for name, output in outputs.items()}
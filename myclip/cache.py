@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+
+CACHE_DIR = "./cache/"
+
+
+def fileDigest(path):
+    # 用文件大小和修改时间标识模型文件，避免每次启动都把几百MB的权重完整哈希一遍
+    if not os.path.isfile(path):
+        return os.path.basename(path)
+    st = os.stat(path)
+    return f"{os.path.basename(path)}-{st.st_size}-{st.st_mtime_ns}"
+
+
+# dtype区分同一个模型在不同设备上的精度（GPU上fp16、CPU上fp32），不同精度的特征不能混用
+def textKey(model_id, label_col, texts, dtype=None):
+    buff = json.dumps([model_id, label_col, texts, str(dtype)], ensure_ascii=False)
+    return hashlib.sha1(buff.encode('utf-8')).hexdigest()
+
+
+def loadText(key):
+    path = os.path.join(CACHE_DIR, f"text-{key}.npy")
+    if not os.path.isfile(path):
+        return None
+    # copy-on-write的内存映射，按需读入，且得到的数组可写
+    return np.load(path, mmap_mode='c')
+
+
+def saveText(key, features):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f"text-{key}.npy")
+    # 先写临时文件再替换，避免多个进程同时启动时读到写了一半的缓存
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, features)
+    os.replace(tmp_path, path)
+
+
+class ImageStore(object):
+    # 图片特征的持久化存储，换标签或提示词时不需要重新计算图片特征
+    # features.f16: 归一化后的图片特征，float16矩阵，只追加写入，读取时内存映射
+    # index.tsv: 每行 "图片路径|mtime|大小\t行号"，同样只追加写入
+    def __init__(self, model_id):
+        self.path = os.path.join(CACHE_DIR, "image-" + hashlib.sha1(model_id.encode('utf-8')).hexdigest())
+        self.features_path = os.path.join(self.path, "features.f16")
+        self.index_path = os.path.join(self.path, "index.tsv")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        os.makedirs(self.path, exist_ok=True)
+
+        self.dim = None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.dim = json.load(f)['dim']
+
+        # 写特征时中断会留下不完整的最后一行，截断到整行，否则之后追加的行都会和索引错位
+        if self.dim is not None and os.path.isfile(self.features_path):
+            row_bytes = self.dim * 2
+            size = os.path.getsize(self.features_path)
+            if size % row_bytes:
+                os.truncate(self.features_path, size - size % row_bytes)
+
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            # 写索引时中断，最后一行可能不完整（行号被截断），同样截断到最后一个完整的行
+            with open(self.index_path, 'rb+') as f:
+                data = f.read()
+                if data and not data.endswith(b'\n'):
+                    f.truncate(data.rfind(b'\n') + 1)
+            rows = self.numRows()
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    key, row = line.rstrip('\n').rsplit('\t', 1)
+                    # 写特征后、写索引前中断时，索引可能指向不存在的行
+                    if int(row) < rows:
+                        self.index[key] = int(row)
+        self.features = None
+
+    def key(self, img_path):
+        st = os.stat(img_path)
+        return f"{os.path.abspath(img_path)}|{st.st_mtime_ns}|{st.st_size}"
+
+    def numRows(self):
+        if self.dim is None or not os.path.isfile(self.features_path):
+            return 0
+        return os.path.getsize(self.features_path) // (self.dim * 2)
+
+    def missing(self, img_paths):
+        # 还没有特征（或文件已经修改过）的图片，去重后按原顺序返回
+        return [p for p in dict.fromkeys(img_paths) if self.key(p) not in self.index]
+
+    def add(self, img_paths, features):
+        features = np.ascontiguousarray(features, dtype=np.float16)
+        if self.dim is None:
+            self.dim = features.shape[1]
+            with open(self.meta_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self.dim}, f)
+
+        # 先写特征，再写索引
+        with open(self.features_path, 'ab') as f:
+            start = f.tell() // (self.dim * 2)
+            f.write(features.tobytes())
+        lines = []
+        for i, img_path in enumerate(img_paths):
+            key = self.key(img_path)
+            self.index[key] = start + i
+            lines.append(f"{key}\t{start + i}\n")
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+
+    def get(self, img_paths):
+        # 返回[N, dim]的float16特征，图片必须已经add过
+        rows = self.numRows()
+        if self.features is None or len(self.features) != rows:
+            self.features = np.memmap(self.features_path, dtype=np.float16, mode='r', shape=(rows, self.dim))
+        return self.features[[self.index[self.key(p)] for p in img_paths]]
@@ -1,9 +1,23 @@
 # https://github.com/openai/CLIP
+import os
+import threading
 import torch
 import clip
 
+from myclip.cache import fileDigest, textKey, loadText, saveText
+from myclip import metrics
+from myclip.transform import FrameTransform
+from myclip.utils import mergeTexts
+
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+model_arch = "ViT-B/32"
+label_col = 2 # 使用英文标签
+labels = []
+label_lock = threading.RLock() # 修改标签时加锁
+# (labels, text_features)，在label_lock内整体替换，predict只读取一次，标签和特征总是对应的
+label_state = ([], None)
+batch_size = 32 # predict_batch单次前向的最大图片数
 
 
 def setup(labels):
@@ -12,38 +26,151 @@ def setup(labels):
 
 
 def loadModel():
-    global model, preprocess
-    model, preprocess = clip.load("ViT-B/32", download_root='./models/')
+    global model, preprocess, preprocess_frame
+    model, preprocess = clip.load(model_arch, download_root='./models/')
+    # 直接处理摄像头BGR帧，预分配3个输入缓冲区供流水线使用
+    preprocess_frame = FrameTransform(model.visual.input_resolution, crop=True, buffers=3, device=device)
+
+
+# 标识模型权重，文本和图像模型在同一个checkpoint中
+def modelId(tower='text'):
+    ckpt_path = os.path.join('./models/', os.path.basename(clip.clip._MODELS[model_arch]))
+    return f"{model_arch}:{fileDigest(ckpt_path)}"
+
+
+def calcText(new_labels):
+    global labels, text_features, label_state
+
+    texts = [x[label_col] for x in new_labels]
+
+    # 命中缓存时直接读入，跳过文本模型
+    key = textKey(modelId(), label_col, texts, model.dtype)
+    cached = loadText(key)
+    if cached is not None:
+        features = torch.from_numpy(cached).to(device)
+    else:
+        features = encodeText(texts)
+        saveText(key, features.cpu().numpy())
+
+    with label_lock:
+        labels, text_features = list(new_labels), features
+        label_state = (labels, text_features)
+
 
+def updateLabels(new_labels):
+    global labels, text_features, label_state
 
-def calcText(labels):
-    global text_features
+    # 只编码新增或修改过的文本，其余行直接从旧的特征矩阵中取
+    with label_lock:
+        missing, idxs = mergeTexts([x[label_col] for x in labels], [x[label_col] for x in new_labels])
+        features = text_features
+        if missing:
+            features = torch.cat([features, encodeText(missing).to(features.dtype)])
+        # 整体替换引用，predict不会看到更新到一半的矩阵
+        labels, text_features = list(new_labels), features[idxs]
+        label_state = (labels, text_features)
 
-    # 使用英文标签
-    labels = [x[2] for x in labels]
 
-    text = clip.tokenize(labels).to(device)
-    
+def encodeText(texts):
+    text = clip.tokenize(texts).to(device)
+
     with torch.no_grad():
         text_features = model.encode_text(text)
         text_features /= text_features.norm(dim=1, keepdim=True)
 
+    return text_features
 
-def predict(img):
 
-    image = preprocess(img).unsqueeze(0).to(device)
+def topk(logits_per_image, k, softmax=True):
+    # 在设备上选出top-k，只把k个结果传回主机
+    # softmax只需要对选出的k个值计算: exp(x - logsumexp)，不生成整个概率矩阵
+    logits_per_image = logits_per_image.float()
+    values, idxs = logits_per_image.topk(min(k, logits_per_image.shape[-1]), dim=-1)
+    if softmax:
+        values = (values - logits_per_image.logsumexp(dim=-1, keepdim=True)).exp()
+    return idxs, values
 
-    with torch.no_grad(), torch.cuda.amp.autocast():
 
-        image_features = model.encode_image(image)
-        image_features /= image_features.norm(dim=1, keepdim=True)
+def predict(img, softmax=True, return_labels=False):
+    predict_labels, features = label_state
 
-        logit_scale = model.logit_scale.exp()
-        logits_per_image = logit_scale * image_features @ text_features.t()
+    with metrics.timer('predict'):
+        image = preprocess(img).unsqueeze(0).to(device)
+
+        with torch.no_grad(), torch.cuda.amp.autocast():
+
+            image_features = model.encode_image(image)
+            image_features /= image_features.norm(dim=1, keepdim=True)
+
+            logit_scale = model.logit_scale.exp()
+            logits_per_image = logit_scale * image_features @ features.t()
+            idxs, probs = topk(logits_per_image, 1, softmax)
+
+        # 只传回一个下标和一个概率
+        max_i, max_p = idxs.item(), probs.item()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
+    return max_i, max_p
 
-        probs = logits_per_image.softmax(dim=-1).cpu().tolist()[0]
 
-    max_p = max(probs)
-    max_i = probs.index(max_p)
+def encodeImage(image):
+    # 未归一化的图像特征
+    return model.encode_image(image.to(device))
 
+
+# 单次图像前向（encodeImage、predict_batch的每一段）的最大图片数
+def imageBatchSize(max_batch_size=None):
+    return max_batch_size or batch_size
+
+
+# 批量预测，imgs可以是PIL图片列表，也可以是已经预处理并stack好的[N, 3, H, W]张量
+# 返回每张图片的top-k下标和概率: ([[i, ...], ...], [[p, ...], ...])
+# softmax=False时返回未归一化的logits，顺序不变，只需要排序时省去归一化
+# return_labels=True时额外返回这次预测使用的标签列表，下标要在这个列表中查找，预测期间标签可能已被修改
+def predict_batch(imgs, k=1, max_batch_size=None, softmax=True, return_labels=False):
+    max_batch_size = imageBatchSize(max_batch_size)
+
+    with metrics.timer('preprocess'):
+        if isinstance(imgs, torch.Tensor):
+            images = imgs
+        else:
+            images = torch.stack([preprocess(img) for img in imgs])
+
+    predict_labels, features = label_state # 整个batch使用同一份标签和标签特征
+
+    max_i, max_p = [], []
+    for start in range(0, len(images), max_batch_size):
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            with metrics.timer('encode_image'):
+                image_features = encodeImage(images[start:start + max_batch_size])
+
+            with metrics.timer('classify'):
+                image_features /= image_features.norm(dim=1, keepdim=True)
+
+                logit_scale = model.logit_scale.exp()
+                logits_per_image = logit_scale * image_features @ features.t()
+
+                idxs, probs = topk(logits_per_image, k, softmax)
+
+                max_i += idxs.cpu().tolist()
+                max_p += probs.cpu().tolist()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
     return max_i, max_p
+
+
+# 由归一化后的图像特征（例如缓存的特征）计算top-k，返回值和predict_batch相同
+def predictFeatures(image_features, k=1, softmax=True, return_labels=False):
+    predict_labels, features = label_state
+
+    with torch.no_grad():
+        image_features = torch.as_tensor(image_features, device=device).to(features.dtype)
+        logit_scale = model.logit_scale.exp()
+        logits_per_image = logit_scale * image_features @ features.t()
+        idxs, probs = topk(logits_per_image, k, softmax)
+
+    if return_labels:
+        return idxs.cpu().tolist(), probs.cpu().tolist(), predict_labels
+    return idxs.cpu().tolist(), probs.cpu().tolist()
@@ -1,9 +1,29 @@
 # https://github.com/OFA-Sys/Chinese-CLIP
+import os
+import threading
 import torch
 import cn_clip.clip as clip
+from cn_clip.clip.utils import _MODELS, _MODEL_INFO, create_model, image_transform
+
+from myclip.cache import fileDigest, textKey, loadText, saveText
+from myclip import metrics
+from myclip.transform import FrameTransform
+from myclip.utils import mergeTexts
 
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
+model_arch = "ViT-B-16"
+label_col = 1 # 使用中文标签
+labels = []
+label_lock = threading.RLock() # 修改标签时加锁
+# (labels, text_features)，在label_lock内整体替换，predict只读取一次，标签和特征总是对应的
+label_state = ([], None)
+batch_size = 32 # predict_batch单次前向的最大图片数
+# 预先保存好的state_dict，载入时内存映射，不再从checkpoint重建模型，None表示不使用
+prebaked_model_path = "./models/vit-b-16.prebaked.pt"
+# 需要torch.load(mmap=True)、meta设备和load_state_dict(assign=True)，旧版本torch直接使用load_from_name
+prebaked_supported = tuple(int(x) for x in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1)
+quantize = False # CPU上对图像模型的Linear层做INT8动态量化，文本特征仍由fp32模型计算
 
 
 def setup(labels):
@@ -12,38 +32,192 @@ def setup(labels):
 
 
 def loadModel():
-    global model, preprocess
-    model, preprocess = clip.load_from_name("ViT-B-16", download_root='./models/')
+    global model, preprocess, preprocess_frame
+    try:
+        model = loadPrebaked()
+    except Exception as e:
+        # 文件损坏等情况，退回load_from_name并重新生成
+        print(f"Warning: failed to load {prebaked_model_path} ({type(e).__name__}: {e}), loading {model_arch} from the checkpoint")
+        model = None
+    if model is not None:
+        preprocess = image_transform(_MODEL_INFO[model_arch]['input_resolution'])
+    else:
+        model, preprocess = clip.load_from_name(model_arch, download_root='./models/')
+        savePrebaked()
     model.eval()
+    if quantize and device == "cpu":
+        # 量化只需几秒，缓存的是量化前的fp32权重（prebaked），量化后的模型不缓存
+        model.visual = torch.ao.quantization.quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+    # 直接处理摄像头BGR帧，预分配3个输入缓冲区供流水线使用
+    preprocess_frame = FrameTransform(_MODEL_INFO[model_arch]['input_resolution'], buffers=3, device=device)
+
+
+def loadPrebaked():
+    if not prebaked_supported or not prebaked_model_path or not os.path.isfile(prebaked_model_path):
+        return None
+    checkpoint = torch.load(prebaked_model_path, map_location="cpu", mmap=True, weights_only=True)
+    # checkpoint更新后，或者保存时的设备不同（CPU上全部是fp32，GPU上部分是fp16，dtype不同）时重新生成
+    if checkpoint['model_id'] != modelId() or checkpoint.get('device') != device:
+        return None
+
+    # 在meta设备上建立模型结构，不分配内存也不做随机初始化
+    with torch.device("meta"):
+        prebaked_model = create_model(_MODEL_INFO[model_arch]['struct'])
+    # 保存的就是运行时的dtype，assign=True直接使用内存映射的张量（包括dtype），CPU上不复制权重
+    prebaked_model.load_state_dict(checkpoint['state_dict'], assign=True)
+    return prebaked_model.to(device)
+
+
+def savePrebaked():
+    if not prebaked_supported or not prebaked_model_path:
+        return
+    # 按load_from_name在当前设备上得到的dtype保存（CPU上是fp32），载入时不需要再转换
+    state_dict = {k: v.cpu() for k, v in model.state_dict().items()}
+    tmp_path = f"{prebaked_model_path}.{os.getpid()}.tmp"
+    torch.save({'model_id': modelId(), 'device': device, 'state_dict': state_dict}, tmp_path)
+    os.replace(tmp_path, prebaked_model_path)
+
+
+# 标识模型权重，文本和图像模型在同一个checkpoint中
+def modelId(tower='text'):
+    model_id = f"{model_arch}:{fileDigest(os.path.join('./models/', _MODELS[model_arch][1]))}"
+    if tower == 'image' and quantize and device == "cpu":
+        model_id += ":int8"
+    return model_id
+
+
+def calcText(new_labels):
+    global labels, text_features, label_state
+
+    texts = [x[label_col] for x in new_labels]
+
+    # 命中缓存时直接读入，跳过文本模型
+    key = textKey(modelId(), label_col, texts, model.dtype)
+    cached = loadText(key)
+    if cached is not None:
+        features = torch.from_numpy(cached).to(device)
+    else:
+        features = encodeText(texts)
+        saveText(key, features.cpu().numpy())
+
+    with label_lock:
+        labels, text_features = list(new_labels), features
+        label_state = (labels, text_features)
+
+
+def updateLabels(new_labels):
+    global labels, text_features, label_state
+
+    # 只编码新增或修改过的文本，其余行直接从旧的特征矩阵中取
+    with label_lock:
+        missing, idxs = mergeTexts([x[label_col] for x in labels], [x[label_col] for x in new_labels])
+        features = text_features
+        if missing:
+            features = torch.cat([features, encodeText(missing).to(features.dtype)])
+        # 整体替换引用，predict不会看到更新到一半的矩阵
+        labels, text_features = list(new_labels), features[idxs]
+        label_state = (labels, text_features)
+
+
+def encodeText(texts):
+    text = clip.tokenize(texts).to(device)
 
-
-def calcText(labels):
-    global text_features
-
-    # 使用中文标签
-    labels = [x[1] for x in labels]
-
-    text = clip.tokenize(labels).to(device)
-    
     with torch.no_grad():
         text_features = model.encode_text(text)
         text_features /= text_features.norm(dim=1, keepdim=True)
 
+    return text_features
 
-def predict(img):
 
-    image = preprocess(img).unsqueeze(0).to(device)
-    
-    with torch.no_grad(), torch.cuda.amp.autocast():
-        image_features = model.encode_image(image)
-        image_features /= image_features.norm(dim=1, keepdim=True)
+def topk(logits_per_image, k, softmax=True):
+    # 在设备上选出top-k，只把k个结果传回主机
+    # softmax只需要对选出的k个值计算: exp(x - logsumexp)，不生成整个概率矩阵
+    logits_per_image = logits_per_image.float()
+    values, idxs = logits_per_image.topk(min(k, logits_per_image.shape[-1]), dim=-1)
+    if softmax:
+        values = (values - logits_per_image.logsumexp(dim=-1, keepdim=True)).exp()
+    return idxs, values
 
-        logit_scale = model.logit_scale.exp()
-        logits_per_image = logit_scale * image_features @ text_features.t()
 
-        probs = logits_per_image.softmax(dim=-1).cpu().tolist()[0]
+def predict(img, softmax=True, return_labels=False):
+    predict_labels, features = label_state
+
+    with metrics.timer('predict'):
+        image = preprocess(img).unsqueeze(0).to(device)
+
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            image_features = model.encode_image(image)
+            image_features /= image_features.norm(dim=1, keepdim=True)
+
+            logit_scale = model.logit_scale.exp()
+            logits_per_image = logit_scale * image_features @ features.t()
+            idxs, probs = topk(logits_per_image, 1, softmax)
 
-    max_p = max(probs)
-    max_i = probs.index(max_p)
+        # 只传回一个下标和一个概率
+        max_i, max_p = idxs.item(), probs.item()
 
+    if return_labels:
+        return max_i, max_p, predict_labels
     return max_i, max_p
+
+
+def encodeImage(image):
+    # 未归一化的图像特征
+    return model.encode_image(image.to(device))
+
+
+# 单次图像前向（encodeImage、predict_batch的每一段）的最大图片数
+def imageBatchSize(max_batch_size=None):
+    return max_batch_size or batch_size
+
+
+# 批量预测，imgs可以是PIL图片列表，也可以是已经预处理并stack好的[N, 3, H, W]张量
+# 返回每张图片的top-k下标和概率: ([[i, ...], ...], [[p, ...], ...])
+# softmax=False时返回未归一化的logits，顺序不变，只需要排序时省去归一化
+# return_labels=True时额外返回这次预测使用的标签列表，下标要在这个列表中查找，预测期间标签可能已被修改
+def predict_batch(imgs, k=1, max_batch_size=None, softmax=True, return_labels=False):
+    max_batch_size = imageBatchSize(max_batch_size)
+
+    with metrics.timer('preprocess'):
+        if isinstance(imgs, torch.Tensor):
+            images = imgs
+        else:
+            images = torch.stack([preprocess(img) for img in imgs])
+
+    predict_labels, features = label_state # 整个batch使用同一份标签和标签特征
+
+    max_i, max_p = [], []
+    for start in range(0, len(images), max_batch_size):
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            with metrics.timer('encode_image'):
+                image_features = encodeImage(images[start:start + max_batch_size])
+
+            with metrics.timer('classify'):
+                image_features /= image_features.norm(dim=1, keepdim=True)
+
+                logit_scale = model.logit_scale.exp()
+                logits_per_image = logit_scale * image_features @ features.t()
+
+                idxs, probs = topk(logits_per_image, k, softmax)
+
+                max_i += idxs.cpu().tolist()
+                max_p += probs.cpu().tolist()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
+    return max_i, max_p
+
+
+# 由归一化后的图像特征（例如缓存的特征）计算top-k，返回值和predict_batch相同
+def predictFeatures(image_features, k=1, softmax=True, return_labels=False):
+    predict_labels, features = label_state
+
+    with torch.no_grad():
+        image_features = torch.as_tensor(image_features, device=device).to(features.dtype)
+        logit_scale = model.logit_scale.exp()
+        logits_per_image = logit_scale * image_features @ features.t()
+        idxs, probs = topk(logits_per_image, k, softmax)
+
+    if return_labels:
+        return idxs.cpu().tolist(), probs.cpu().tolist(), predict_labels
+    return idxs.cpu().tolist(), probs.cpu().tolist()
@@ -0,0 +1,292 @@
+# https://github.com/OFA-Sys/Chinese-CLIP
+import os
+import json
+import threading
+import numpy as np
+import torch
+import onnxruntime as ort
+import cn_clip.clip as clip
+from cn_clip.clip.utils import _MODEL_INFO, image_transform
+
+from myclip.cache import fileDigest, textKey, loadText, saveText
+from myclip import metrics
+from myclip.transform import FrameTransform
+from myclip.utils import mergeTexts
+
+
+# CPU上fp16没有加速，默认使用fp32的ONNX模型
+img_onnx_model_path="./models/vit-b-16.img.fp32.onnx"
+txt_onnx_model_path="./models/vit-b-16.txt.fp32.onnx"
+# 图像模型的INT8动态量化版本，由fp32模型生成并缓存，fp32模型更新后重新生成
+img_int8_onnx_model_path="./models/vit-b-16.img.int8.onnx"
+quantize = False # 使用INT8量化的图像模型，文本特征仍由fp32模型计算
+# 优先使用convert/optimize_onnx.py离线优化过的<模型>.opt.onnx，不存在或比原模型旧时使用原模型
+optimized = True
+# 图像模型+归一化+相似度+top-k融合成的一个图（pytorch_to_onnx.py --convert-head），None表示不使用
+# 只有导出时的标签和当前标签相同、k不超过导出时的top-k时才使用，否则自动退回逐步计算；quantize=True时不使用
+head_onnx_model_path = None
+head_model = None
+head_active = False
+model_arch = "ViT-B-16"
+label_col = 1 # 使用中文标签
+labels = []
+label_lock = threading.RLock() # 修改标签时加锁
+text_features = None
+# (labels, text_features, head_active)，在label_lock内整体替换，predict只读取一次，标签、特征和融合图的状态总是对应的
+label_state = ([], None, False)
+txt_onnx_model = None
+batch_size = 32 # predict_batch单次前向的最大图片数，旧的不带动态batch的ONNX模型会自动限制为导出时的batch大小
+
+device = "cpu" # 只使用CPUExecutionProvider
+# session不能跨fork使用，fork出的进程无法共享权重，不能用于WorkerPool
+fork_shared = False
+
+# onnxruntime参数
+intra_op_num_threads = 0 # 单个算子内部的线程数，0表示由onnxruntime决定（物理核数）
+inter_op_num_threads = 0 # 算子之间并行的线程数，大于1时启用并行执行模式
+graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+
+def setup(labels):
+    calcText(labels)
+    loadModel()
+
+
+def optimizedPath(onnx_model_path):
+    if not optimized or not onnx_model_path.endswith('.onnx'):
+        return onnx_model_path
+    opt_path = f"{onnx_model_path[:-len('.onnx')]}.opt.onnx"
+    if os.path.isfile(opt_path) and os.path.getmtime(opt_path) >= os.path.getmtime(onnx_model_path):
+        return opt_path
+    return onnx_model_path
+
+
+def createSession(onnx_model_path):
+    onnx_model_path = optimizedPath(onnx_model_path)
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_num_threads
+    options.inter_op_num_threads = inter_op_num_threads
+    if inter_op_num_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    options.graph_optimization_level = graph_optimization_level
+    return ort.InferenceSession(onnx_model_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def maxBatchSize(session, default):
+    # 动态batch维度是字符串，固定batch时是导出时的大小
+    dim = session.get_inputs()[0].shape[0]
+    return dim if isinstance(dim, int) else default
+
+
+def quantizeModel(onnx_model_path, int8_onnx_model_path):
+    # 只量化MatMul和Gemm（Transformer的主要计算量），动态量化的Conv在CPU上反而更慢
+    if os.path.isfile(int8_onnx_model_path) and \
+            os.path.getmtime(int8_onnx_model_path) >= os.path.getmtime(onnx_model_path):
+        return
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    tmp_path = f"{int8_onnx_model_path}.{os.getpid()}.tmp.onnx"
+    quantize_dynamic(onnx_model_path, tmp_path, op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+    os.replace(tmp_path, int8_onnx_model_path)
+
+
+def loadHead():
+    global head_model, head_texts, head_k
+    head_model = createSession(head_onnx_model_path)
+    meta = head_model.get_modelmeta().custom_metadata_map
+    head_texts, head_k = json.loads(meta['labels']), int(meta['top_k'])
+    checkHead()
+
+
+def checkHead():
+    # 标签变化后调用，判断融合的图是否仍然可用，并更新label_state
+    global head_active, label_state
+    with label_lock:
+        head_active = head_model is not None and head_texts == [x[label_col] for x in labels]
+        label_state = (labels, text_features, head_active)
+
+
+def imageModelPath():
+    return img_int8_onnx_model_path if quantize else img_onnx_model_path
+
+
+def loadModel():
+    global model, preprocess, preprocess_frame, head_model
+    # 图像模型
+    if quantize:
+        quantizeModel(img_onnx_model_path, img_int8_onnx_model_path)
+    model = createSession(imageModelPath())
+    # 融合的图包含fp32的图像模型，INT8模式下不使用，否则实际运行的仍然是fp32模型
+    if head_onnx_model_path and not quantize:
+        loadHead()
+    else:
+        head_model = None
+        checkHead()
+    preprocess = image_transform(_MODEL_INFO[model_arch]['input_resolution'])
+    # 直接处理摄像头BGR帧，预分配3个输入缓冲区供流水线使用
+    preprocess_frame = FrameTransform(_MODEL_INFO[model_arch]['input_resolution'], buffers=3)
+
+
+# 标识文本('text')或图像('image')模型
+def modelId(tower='text'):
+    return f"{model_arch}:{fileDigest(optimizedPath(txt_onnx_model_path if tower == 'text' else imageModelPath()))}"
+
+
+def calcText(new_labels):
+    global labels, text_features
+
+    texts = [x[label_col] for x in new_labels]
+
+    # 命中缓存时直接读入，跳过文本模型
+    key = textKey(modelId(), label_col, texts)
+    cached = loadText(key)
+    if cached is not None:
+        features = cached
+    else:
+        features = encodeText(texts)
+        saveText(key, features)
+
+    with label_lock:
+        labels, text_features = list(new_labels), features
+        checkHead()
+
+
+def updateLabels(new_labels):
+    global labels, text_features
+
+    # 只编码新增或修改过的文本，其余行直接从旧的特征矩阵中取
+    with label_lock:
+        missing, idxs = mergeTexts([x[label_col] for x in labels], [x[label_col] for x in new_labels])
+        features = text_features
+        if missing:
+            features = np.concatenate([features, encodeText(missing)])
+        # 整体替换引用，predict不会看到更新到一半的矩阵
+        labels, text_features = list(new_labels), features[idxs]
+        checkHead()
+
+
+def encodeText(texts):
+    global txt_onnx_model
+    text = clip.tokenize(texts).numpy()
+
+    # 文本模型，第一次需要编码文本时才载入，之后增量更新标签时复用
+    if txt_onnx_model is None:
+        txt_onnx_model = createSession(txt_onnx_model_path)
+
+    # 按模型支持的batch分批计算
+    max_batch_size = maxBatchSize(txt_onnx_model, batch_size)
+    text_features = []
+    for start in range(0, len(text), max_batch_size):
+        text_feature = txt_onnx_model.run(['unnorm_text_features'], {'text': text[start:start + max_batch_size]})[0]
+        text_features.append(text_feature)
+    text_features = np.concatenate(text_features)
+    text_features /= np.linalg.norm(text_features, axis=1, keepdims=True) # 归一化
+
+    return text_features
+
+
+def topk(logits_per_image, k, softmax=True):
+    # argpartition是O(标签数)的选择，只对选出的k个排序
+    # softmax只需要对选出的k个值计算: exp(x - max) / sum(exp(logits - max))
+    k = min(k, logits_per_image.shape[-1])
+    idxs = np.argpartition(-logits_per_image, k - 1, axis=-1)[:, :k]
+    values = np.take_along_axis(logits_per_image, idxs, axis=-1)
+    order = np.argsort(-values, axis=-1)
+    idxs, values = np.take_along_axis(idxs, order, axis=-1), np.take_along_axis(values, order, axis=-1)
+    if softmax:
+        x_max = logits_per_image.max(axis=-1, keepdims=True)
+        values = np.exp(values - x_max) / np.exp(logits_per_image - x_max).sum(axis=-1, keepdims=True)
+    return idxs, values
+
+
+def predictHead(images, k):
+    # 一次run得到top-k，不需要在Python中做归一化、矩阵乘法和排序
+    probs, idxs = head_model.run(['probs', 'idxs'], {'image': images})
+    return idxs[:, :k].tolist(), probs[:, :k].tolist()
+
+
+def predict(img, softmax=True, return_labels=False):
+    predict_labels, features, use_head = label_state
+
+    with metrics.timer('predict'):
+        image = preprocess(img).unsqueeze(0).numpy()
+
+        if use_head and softmax:
+            max_i, max_p = predictHead(image, 1)
+            max_i, max_p = max_i[0][0], max_p[0][0]
+        else:
+            image_features = encodeImage(image)
+            image_features /= np.linalg.norm(image_features, axis=1, keepdims=True)
+
+            logits_per_image = 100 * image_features @ features.T
+            idxs, probs = topk(logits_per_image, 1, softmax)
+
+            max_i = int(idxs[0, 0])
+            max_p = float(probs[0, 0])
+
+    if return_labels:
+        return max_i, max_p, predict_labels
+    return max_i, max_p
+
+
+def encodeImage(image):
+    # 未归一化的图像特征
+    return model.run(['unnorm_image_features'], {'image': np.asarray(image, dtype=np.float32)})[0]
+
+
+# 单次图像前向（encodeImage、predict_batch的每一段）的最大图片数
+def imageBatchSize(max_batch_size=None):
+    return maxBatchSize(model, max_batch_size or batch_size)
+
+
+# 批量预测，imgs可以是PIL图片列表，也可以是已经预处理并stack好的[N, 3, H, W]张量
+# 返回每张图片的top-k下标和概率: ([[i, ...], ...], [[p, ...], ...])
+# softmax=False时返回未归一化的logits，顺序不变，只需要排序时省去归一化
+# return_labels=True时额外返回这次预测使用的标签列表，下标要在这个列表中查找，预测期间标签可能已被修改
+def predict_batch(imgs, k=1, max_batch_size=None, softmax=True, return_labels=False):
+    max_batch_size = imageBatchSize(max_batch_size)
+
+    with metrics.timer('preprocess'):
+        if isinstance(imgs, (torch.Tensor, np.ndarray)):
+            images = np.asarray(imgs, dtype=np.float32)
+        else:
+            images = torch.stack([preprocess(img) for img in imgs]).numpy()
+
+    predict_labels, features, use_head = label_state # 整个batch使用同一份标签和标签特征
+    use_head = use_head and k <= head_k and softmax
+
+    max_i, max_p = [], []
+    for start in range(0, len(images), max_batch_size):
+        if use_head:
+            with metrics.timer('head'):
+                idxs, probs = predictHead(images[start:start + max_batch_size], k)
+            max_i += idxs
+            max_p += probs
+            continue
+
+        with metrics.timer('encode_image'):
+            image_features = encodeImage(images[start:start + max_batch_size])
+
+        with metrics.timer('classify'):
+            image_features /= np.linalg.norm(image_features, axis=1, keepdims=True)
+
+            logits_per_image = 100 * image_features @ features.T
+            idxs, probs = topk(logits_per_image, k, softmax)
+
+            max_i += idxs.tolist()
+            max_p += probs.tolist()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
+    return max_i, max_p
+
+
+# 由归一化后的图像特征（例如缓存的特征）计算top-k，返回值和predict_batch相同
+def predictFeatures(image_features, k=1, softmax=True, return_labels=False):
+    predict_labels, features, _ = label_state
+
+    logits_per_image = 100 * np.asarray(image_features, dtype=np.float32) @ features.T
+    idxs, probs = topk(logits_per_image, k, softmax)
+
+    if return_labels:
+        return idxs.tolist(), probs.tolist(), predict_labels
+    return idxs.tolist(), probs.tolist()
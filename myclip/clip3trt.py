@@ -1,13 +1,26 @@
 # https://github.com/OFA-Sys/Chinese-CLIP
+import threading
 import torch
 import cn_clip.clip as clip
-from cn_clip.deploy.tensorrt_utils import TensorRTModel
 from cn_clip.clip.utils import _MODEL_INFO, image_transform
 
+from convert.tensorrt_utils import TensorRTModel
+from myclip.cache import fileDigest, textKey, loadText, saveText
+from myclip import metrics
+from myclip.transform import FrameTransform
+from myclip.utils import mergeTexts
+
 
 img_trt_model_path="./models/vit-b-16.img.fp16.trt"
 txt_trt_model_path="./models/vit-b-16.txt.fp16.trt"
 model_arch = "ViT-B-16"
+label_col = 1 # 使用中文标签
+labels = []
+label_lock = threading.RLock() # 修改标签时加锁
+# (labels, text_features)，在label_lock内整体替换，predict只读取一次，标签和特征总是对应的
+label_state = ([], None)
+txt_trt_model = None
+batch_size = None # predict_batch单次前向的最大图片数，None表示使用engine支持的最大batch（转换时的--max-batch-size）
 
 
 def setup(labels):
@@ -16,42 +29,164 @@ def setup(labels):
 
 
 def loadModel():
-    global model, preprocess
-    # 图像模型
-    model = TensorRTModel(img_trt_model_path)
+    global model, preprocess, preprocess_frame
+    # 图像模型，输出直接复用engine的输出缓冲区，每帧推理不再分配显存
+    model = TensorRTModel(img_trt_model_path, reuse_outputs=True)
     preprocess = image_transform(_MODEL_INFO[model_arch]['input_resolution'])
+    # 直接处理摄像头BGR帧，在GPU上完成缩放和归一化，预分配3个输入缓冲区供流水线使用
+    preprocess_frame = FrameTransform(_MODEL_INFO[model_arch]['input_resolution'], buffers=3, device="cuda")
+
+
+def maxBatchSize(trt_model, input_name):
+    # engine优化profile中输入的最大batch
+    return trt_model.engine.get_profile_shape(0, input_name)[2][0]
+
+
+# 标识文本('text')或图像('image')模型
+def modelId(tower='text'):
+    return f"{model_arch}:{fileDigest(txt_trt_model_path if tower == 'text' else img_trt_model_path)}"
+
+
+def calcText(new_labels):
+    global labels, text_features, label_state
+
+    texts = [x[label_col] for x in new_labels]
+
+    # 命中缓存时直接读入，不再反序列化文本模型的engine
+    key = textKey(modelId(), label_col, texts)
+    cached = loadText(key)
+    if cached is not None:
+        features = torch.from_numpy(cached).cuda()
+    else:
+        features = encodeText(texts)
+        saveText(key, features.cpu().numpy())
 
+    with label_lock:
+        labels, text_features = list(new_labels), features
+        label_state = (labels, text_features)
 
-def calcText(labels):
-    global text_features
 
-    # 使用中文标签
-    labels = [x[1] for x in labels]
-    text = clip.tokenize(labels).cuda()
+def updateLabels(new_labels):
+    global labels, text_features, label_state
 
-    # 文本模型
-    txt_trt_model = TensorRTModel(txt_trt_model_path)
+    # 只编码新增或修改过的文本，其余行直接从旧的特征矩阵中取
+    with label_lock:
+        missing, idxs = mergeTexts([x[label_col] for x in labels], [x[label_col] for x in new_labels])
+        features = text_features
+        if missing:
+            features = torch.cat([features, encodeText(missing).to(features.dtype)])
+        # 整体替换引用，predict不会看到更新到一半的矩阵
+        labels, text_features = list(new_labels), features[idxs]
+        label_state = (labels, text_features)
+
+
+def encodeText(texts):
+    global txt_trt_model
+    text = clip.tokenize(texts).cuda()
+
+    # 文本模型，第一次需要编码文本时才载入，之后增量更新标签时复用
+    if txt_trt_model is None:
+        txt_trt_model = TensorRTModel(txt_trt_model_path)
     
+    # 按engine支持的最大batch分批计算
+    max_batch_size = maxBatchSize(txt_trt_model, 'text')
     text_features = []
-    for i in range(len(text)):
-        text_feature = txt_trt_model(inputs={'text': torch.unsqueeze(text[i], dim=0)})['unnorm_text_features']
+    for start in range(0, len(text), max_batch_size):
+        text_feature = txt_trt_model(inputs={'text': text[start:start + max_batch_size]})['unnorm_text_features']
         text_features.append(text_feature)
-    text_features = torch.squeeze(torch.stack(text_features), dim=1)
+    text_features = torch.cat(text_features)
     text_features = text_features / text_features.norm(dim=1, keepdim=True) # 归一化
 
+    return text_features
 
-def predict(img):
 
-    image = preprocess(img).unsqueeze(0).cuda()
-    
-    with torch.no_grad(), torch.cuda.amp.autocast():
-        image_features = model(inputs={'image': image})['unnorm_image_features']
-        image_features /= image_features.norm(dim=1, keepdim=True)
+def topk(logits_per_image, k, softmax=True):
+    # 在设备上选出top-k，只把k个结果传回主机
+    # softmax只需要对选出的k个值计算: exp(x - logsumexp)，不生成整个概率矩阵
+    logits_per_image = logits_per_image.float()
+    values, idxs = logits_per_image.topk(min(k, logits_per_image.shape[-1]), dim=-1)
+    if softmax:
+        values = (values - logits_per_image.logsumexp(dim=-1, keepdim=True)).exp()
+    return idxs, values
+
 
-        logits_per_image = 100 * image_features @ text_features.t()
-        probs = logits_per_image.softmax(dim=-1).cpu().tolist()[0]
+def predict(img, softmax=True, return_labels=False):
+    predict_labels, features = label_state
 
-    max_p = max(probs)
-    max_i = probs.index(max_p)
+    with metrics.timer('predict'):
+        image = preprocess(img).unsqueeze(0).cuda()
 
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            image_features = model(inputs={'image': image})['unnorm_image_features']
+            image_features /= image_features.norm(dim=1, keepdim=True)
+
+            logits_per_image = 100 * image_features @ features.t()
+            idxs, probs = topk(logits_per_image, 1, softmax)
+
+        # 只传回一个下标和一个概率
+        max_i, max_p = idxs.item(), probs.item()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
     return max_i, max_p
+
+
+def encodeImage(image):
+    # 未归一化的图像特征
+    return model(inputs={'image': image.cuda()})['unnorm_image_features']
+
+
+# 单次图像前向（encodeImage、predict_batch的每一段）的最大图片数
+def imageBatchSize(max_batch_size=None):
+    # 不超过engine优化profile的最大batch
+    engine_max = maxBatchSize(model, 'image')
+    return min(max_batch_size or batch_size or engine_max, engine_max)
+
+
+# 批量预测，imgs可以是PIL图片列表，也可以是已经预处理并stack好的[N, 3, H, W]张量
+# 返回每张图片的top-k下标和概率: ([[i, ...], ...], [[p, ...], ...])
+# softmax=False时返回未归一化的logits，顺序不变，只需要排序时省去归一化
+# return_labels=True时额外返回这次预测使用的标签列表，下标要在这个列表中查找，预测期间标签可能已被修改
+def predict_batch(imgs, k=1, max_batch_size=None, softmax=True, return_labels=False):
+    max_batch_size = imageBatchSize(max_batch_size)
+
+    with metrics.timer('preprocess'):
+        if isinstance(imgs, torch.Tensor):
+            images = imgs
+        else:
+            images = torch.stack([preprocess(img) for img in imgs])
+
+    predict_labels, features = label_state # 整个batch使用同一份标签和标签特征
+
+    max_i, max_p = [], []
+    for start in range(0, len(images), max_batch_size):
+        with torch.no_grad(), torch.cuda.amp.autocast():
+            with metrics.timer('encode_image'):
+                image_features = encodeImage(images[start:start + max_batch_size])
+
+            with metrics.timer('classify'):
+                image_features /= image_features.norm(dim=1, keepdim=True)
+
+                logits_per_image = 100 * image_features @ features.t()
+                idxs, probs = topk(logits_per_image, k, softmax)
+
+                max_i += idxs.cpu().tolist()
+                max_p += probs.cpu().tolist()
+
+    if return_labels:
+        return max_i, max_p, predict_labels
+    return max_i, max_p
+
+
+# 由归一化后的图像特征（例如缓存的特征）计算top-k，返回值和predict_batch相同
+def predictFeatures(image_features, k=1, softmax=True, return_labels=False):
+    predict_labels, features = label_state
+
+    with torch.no_grad():
+        image_features = torch.as_tensor(image_features, device="cuda").to(features.dtype)
+        logits_per_image = 100 * image_features @ features.t()
+        idxs, probs = topk(logits_per_image, k, softmax)
+
+    if return_labels:
+        return idxs.cpu().tolist(), probs.cpu().tolist(), predict_labels
+    return idxs.cpu().tolist(), probs.cpu().tolist()
@@ -0,0 +1,95 @@
+import time
+import bisect
+import threading
+from contextlib import nullcontext
+
+
+enabled = False # 关闭时timer()直接返回空的上下文管理器，几乎没有开销
+
+# 直方图桶的上界(ms)，0.05ms到约60s按1.25倍递增
+BUCKETS = [0.05 * 1.25 ** i for i in range(64)]
+
+histograms = {}
+lock = threading.Lock()
+_null_timer = nullcontext()
+
+
+class Histogram(object):
+    # 固定分桶的延迟直方图，分位数取所在桶的上界
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for i, cnt in enumerate(self.counts):
+            seen += cnt
+            if cnt and seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "max_ms": self.max,
+        }
+
+
+def record(stage, ms):
+    if not enabled:
+        return
+    with lock:
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].add(ms)
+
+
+class Timer(object):
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, (time.perf_counter() - self.start) * 1000)
+
+
+# 用法: with metrics.timer('encode_image'): ...
+# GPU上的异步计算会被计入之后第一个同步（例如.cpu()）所在的阶段
+def timer(stage):
+    if not enabled:
+        return _null_timer
+    return Timer(stage)
+
+
+def snapshot():
+    with lock:
+        return {stage: h.summary() for stage, h in histograms.items()}
+
+
+def reset():
+    with lock:
+        histograms.clear()
+
+
+def report():
+    lines = []
+    for stage, s in snapshot().items():
+        lines.append(f"{stage:<18}n={s['count']:<8d}mean={s['mean_ms']:7.2f}ms\t"
+                     f"p50={s['p50_ms']:7.2f}ms\tp95={s['p95_ms']:7.2f}ms\tp99={s['p99_ms']:7.2f}ms\tmax={s['max_ms']:7.2f}ms")
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+import os
+import queue
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+import torch
+import torch.multiprocessing as mp
+
+
+def splitCpus(workers):
+    # 把当前进程可用的CPU核按顺序平均分给各个worker
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count()))
+    if len(cpus) < workers:
+        return [None] * workers # 核数不够时不绑定
+    return [cpus[i * len(cpus) // workers:(i + 1) * len(cpus) // workers] for i in range(workers)]
+
+
+def runWorker(backend, cpus, threads, task_q, result_q):
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(threads)
+
+    while True:
+        task = task_q.get()
+        if task is None:
+            break
+        task_id, method, args = task
+        try:
+            with torch.no_grad():
+                result = getattr(backend, method)(*args)
+        except Exception as e:
+            # 异常对象不一定能pickle，转换成RuntimeError
+            result = RuntimeError(f"{type(e).__name__}: {e}")
+        result_q.put((task_id, result))
+
+
+class WorkerPool(object):
+    # N个子进程各自运行同一个CPU后端，每个进程绑定一组CPU核并使用固定的线程数
+    # 子进程由已经setup过的父进程fork得到，PyTorch的权重copy-on-write共享，内存不会增长N倍
+    # 标签在创建时确定，之后父进程中修改标签不会同步到子进程
+    # 有子进程意外退出时，所有未完成的Future都以异常结束，之后的submit直接抛出异常
+    # 不支持onnxruntime后端(clip3ort)：session不能跨fork使用，每个子进程重新创建session时权重各复制一份，
+    # 内存会增长N倍；onnxruntime本身用intra_op_num_threads在单进程内并行
+    def __init__(self, backend, workers, threads=None):
+        # 后端必须明确声明运行在CPU上，CUDA/TensorRT不能在fork出的子进程中使用
+        assert getattr(backend, "device", None) == "cpu", "Error: WorkerPool only supports CPU backends!"
+        assert getattr(backend, "fork_shared", True), \
+            "Error: WorkerPool does not support onnxruntime backends, the weights can't be shared between processes! " \
+            "Use a single process with intra_op_num_threads instead."
+        self.workers = workers
+        cpus = splitCpus(workers)
+        ctx = mp.get_context("fork")
+        # torch.multiprocessing的队列通过共享内存传递张量，不需要序列化整个batch
+        self.task_q = ctx.Queue()
+        self.result_q = ctx.Queue()
+        self.processes = []
+        for i in range(workers):
+            worker_threads = threads or (len(cpus[i]) if cpus[i] else 1)
+            p = ctx.Process(target=runWorker, args=(backend, cpus[i], worker_threads, self.task_q, self.result_q),
+                            daemon=True)
+            p.start()
+            self.processes.append(p)
+
+        self.futures = {}
+        self.lock = threading.Lock()
+        self.closing = False
+        self.broken = None # 子进程意外退出的原因
+        self.stopped = threading.Event() # 所有子进程结束后通知收集线程退出
+        self.task_ids = itertools.count()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def collect(self):
+        # 把子进程返回的结果交给对应的Future，同时检查子进程是否还在运行
+        while True:
+            try:
+                item = self.result_q.get(timeout=0.5)
+            except queue.Empty:
+                if self.stopped.is_set():
+                    break
+                self.checkWorkers()
+                continue
+            task_id, result = item
+            with self.lock:
+                future = self.futures.pop(task_id, None)
+            if future is None: # 子进程退出时已经以异常结束
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def checkWorkers(self):
+        # 不知道退出的子进程正在执行哪个任务，所有未完成的任务都以异常结束
+        if self.closing or self.broken is not None:
+            return
+        dead = [p for p in self.processes if not p.is_alive()]
+        if not dead:
+            return
+        with self.lock:
+            self.broken = RuntimeError(f"Worker process {dead[0].pid} exited unexpectedly with code {dead[0].exitcode}")
+            futures = list(self.futures.values())
+            self.futures.clear()
+        for future in futures:
+            future.set_exception(self.broken)
+
+    def submit(self, method, *args):
+        # 在任意一个空闲的worker中调用backend.method(*args)，返回concurrent.futures.Future
+        future = Future()
+        task_id = next(self.task_ids)
+        with self.lock:
+            if self.broken is not None:
+                raise self.broken
+            self.futures[task_id] = future
+        self.task_q.put((task_id, method, args))
+        return future
+
+    def predict_batch(self, imgs, k=1, softmax=True, return_labels=False):
+        # return_labels=True时返回子进程中的标签，即创建WorkerPool时的标签
+        return self.submit("predict_batch", imgs, k, None, softmax, return_labels).result()
+
+    def map(self, method, batches, *args):
+        # 按顺序返回每个batch的backend.method(batch, *args)，最多同时提交2*workers个batch
+        pending = deque()
+        for batch in batches:
+            pending.append(self.submit(method, batch, *args))
+            if len(pending) >= 2 * self.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self):
+        self.closing = True
+        # 子进程被杀死时可能还持有队列的锁，队列不能再用来传递结束信号，直接终止其他子进程
+        if self.broken is None:
+            for _ in self.processes:
+                self.task_q.put(None)
+        for p in self.processes:
+            if self.broken is not None:
+                p.terminate()
+            p.join()
+        # 结果队列取空后收集线程退出
+        self.stopped.set()
+        self.collector.join()
+        if self.broken is not None:
+            # 不等待写不进去的队列数据，否则解释器退出时会卡住
+            self.task_q.cancel_join_thread()
+            self.result_q.cancel_join_thread()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,140 @@
+import torch
+import torch.nn.functional as F
+
+
+# CLIP和Chinese-CLIP使用相同的归一化参数
+MEAN = (0.48145466, 0.4578275, 0.40821073)
+STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class FrameTransform(object):
+    # 把摄像头的BGR numpy帧直接转换为模型输入，等价于 cvtColor -> Image.fromarray -> preprocess
+    # crop=False: 直接缩放成正方形（Chinese-CLIP的image_transform）
+    # crop=True: 短边缩放到resolution后中心裁剪（OpenAI CLIP的_transform）
+    # buffers: 预分配的输出张量个数，不指定out时轮流复用
+    def __init__(self, resolution, crop=False, buffers=1, device="cpu"):
+        self.resolution = resolution
+        self.crop = crop
+        self.outs = [torch.empty(1, 3, resolution, resolution, device=device) for _ in range(buffers)]
+        self.next = 0
+        # 把 /255、-mean、/std 合并成一次乘加: x * scale + bias
+        std = torch.tensor(STD, device=device).view(1, 3, 1, 1)
+        mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.bias = -mean / std
+
+    def resizeShape(self, h, w):
+        if not self.crop:
+            return self.resolution, self.resolution
+        # 与torchvision.transforms.Resize(int)的取整方式一致
+        if h < w:
+            return self.resolution, int(self.resolution * w / h)
+        return int(self.resolution * h / w), self.resolution
+
+    def __call__(self, frame, out=None):
+        if out is None:
+            out = self.outs[self.next]
+            self.next = (self.next + 1) % len(self.outs)
+
+        # HWC uint8 -> 1CHW，不拷贝
+        image = torch.from_numpy(frame).to(out.device).permute(2, 0, 1).unsqueeze(0)
+
+        h, w = self.resizeShape(*frame.shape[:2])
+        try:
+            # 直接在uint8上缩放，和PIL一样输出取整后的uint8
+            image = F.interpolate(image, size=(h, w), mode='bicubic', align_corners=False, antialias=True)
+        except RuntimeError:
+            # 旧版本torch不支持uint8的bicubic缩放
+            image = F.interpolate(image.float(), size=(h, w), mode='bicubic', align_corners=False, antialias=True)
+            image = image.round_().clamp_(0, 255)
+
+        if self.crop:
+            top = int(round((h - self.resolution) / 2.0))
+            left = int(round((w - self.resolution) / 2.0))
+            image = image[:, :, top:top + self.resolution, left:left + self.resolution]
+
+        # BGR -> RGB，并归一化写入复用的输出张量
+        return torch.addcmul(self.bias, image.flip(1).float(), self.scale, out=out)
+
+
+class TileTransform(object):
+    # 把一帧切成多个区域，一次性预处理成N×3×R×R的batch，用于一帧中有多个物体的场景
+    # grids: 每一层的(行数, 列数)，多层组成金字塔，例如((1, 1), (2, 2), (3, 3))
+    # overlap: 相邻区域重叠的比例，避免物体正好被切开
+    # crop、device和FrameTransform相同，crop=True时每个区域是正方形
+    def __init__(self, resolution, grids=((1, 1), (2, 2)), overlap=0.2, crop=False, device="cpu"):
+        self.resolution = resolution
+        self.grids = [tuple(grid) for grid in grids]
+        self.overlap = overlap
+        self.crop = crop
+        self.device = device
+        std = torch.tensor(STD, device=device).view(1, 3, 1, 1)
+        mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1)
+        self.scale = 1 / (255 * std)
+        self.bias = -mean / std
+
+    def levelRegions(self, h, w, rows, cols):
+        # 一层的区域在原始帧中的像素坐标[(left, top, right, bottom)]，按行、列排列
+        th, tw = h / rows, w / cols
+        # 区域向四周扩展overlap/2
+        bh, bw = min(h, th * (1 + self.overlap)), min(w, tw * (1 + self.overlap))
+        if self.crop:
+            # 正方形取两个方向中较大的边长，否则较长的方向上相邻区域之间会有空隙；不超过画面
+            bh = bw = min(max(bh, bw), h, w)
+
+        def starts(length, n, size):
+            # n个长度为size的区域在[0, length]上均匀分布，两端贴齐画面边缘，n*size不小于length时覆盖整个方向
+            if n == 1:
+                return [(length - size) / 2]
+            return [i * (length - size) / (n - 1) for i in range(n)]
+
+        return [(left, top, left + bw, top + bh) for top in starts(h, rows, bh) for left in starts(w, cols, bw)]
+
+    def regions(self, h, w):
+        # 所有层的区域坐标，按层、行、列排列
+        return [box for rows, cols in self.grids for box in self.levelRegions(h, w, rows, cols)]
+
+    def resize(self, image, size):
+        # 抗锯齿缩小uint8的1×3×H×W图像
+        try:
+            return F.interpolate(image, size=size, mode='bicubic', align_corners=False, antialias=True)
+        except RuntimeError:
+            # 旧版本torch不支持uint8的bicubic缩放
+            image = F.interpolate(image.float(), size=size, mode='bicubic', align_corners=False, antialias=True)
+            return image.round_().clamp_(0, 255)
+
+    def __call__(self, frame):
+        # 返回(模型输入, 区域坐标)
+        h, w = frame.shape[:2]
+        image = torch.from_numpy(frame).to(self.device).permute(2, 0, 1).unsqueeze(0)
+
+        outputs, boxes = [], []
+        works = {} # 相同大小的缩小结果在各层之间共用
+        for rows, cols in self.grids:
+            level_boxes = self.levelRegions(h, w, rows, cols)
+            # 每一层单独把整帧抗锯齿缩小一次，使这一层的区域缩小到约resolution，之后的双线性采样基本不再缩小
+            # 区域本来就会被拉伸成正方形，两个方向分别缩放，只缩小不放大
+            bw, bh = level_boxes[0][2] - level_boxes[0][0], level_boxes[0][3] - level_boxes[0][1]
+            size = (max(1, round(h * min(1.0, self.resolution / bh))), max(1, round(w * min(1.0, self.resolution / bw))))
+            if size not in works:
+                works[size] = image if size == (h, w) else self.resize(image, size)
+            work = works[size].float()
+
+            # 每个区域对应一个仿射变换，一次grid_sample得到这一层的所有区域
+            # 输出的归一化坐标[-1, 1]映射到输入的 [x0, x1] × [y0, y1]（同样归一化到[-1, 1]）
+            b = torch.tensor(level_boxes, dtype=torch.float32)
+            x0, y0, x1, y1 = b[:, 0] / w * 2 - 1, b[:, 1] / h * 2 - 1, b[:, 2] / w * 2 - 1, b[:, 3] / h * 2 - 1
+            theta = torch.zeros(len(level_boxes), 2, 3)
+            theta[:, 0, 0] = (x1 - x0) / 2
+            theta[:, 0, 2] = (x1 + x0) / 2
+            theta[:, 1, 1] = (y1 - y0) / 2
+            theta[:, 1, 2] = (y1 + y0) / 2
+            n = len(level_boxes)
+            grid = F.affine_grid(theta.to(self.device), (n, 3, self.resolution, self.resolution), align_corners=False)
+            outputs.append(F.grid_sample(work.expand(n, -1, -1, -1), grid, mode='bilinear', padding_mode='border',
+                                         align_corners=False))
+            boxes += level_boxes
+
+        # BGR -> RGB和归一化是逐通道的仿射变换，和双线性采样可交换，只对N×3×R×R的结果做一次
+        images = torch.cat(outputs)
+        return torch.addcmul(self.bias, images.flip(1), self.scale, out=images), boxes
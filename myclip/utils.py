@@ -1,5 +1,6 @@
 import time
 import csv
+from PIL import Image
 
 
 last_t = 0
@@ -12,6 +13,16 @@ def getFPS():
     return fps
 
 
+def openImage(fp, size=None):
+    # JPEG按DCT缩放(1/2、1/4、1/8)解码，得到两边都不小于size的最小尺寸，之后的预处理只需要缩放这个小图
+    # 其他格式draft不起作用，仍然完整解码；size为None时完整解码
+    img = Image.open(fp)
+    if size:
+        img.draft('RGB', (size, size))
+    img.load()
+    return img
+
+
 def loadLabels(csv_file):
     labels = []
     with open(csv_file, 'r', encoding='gbk') as file:
@@ -19,4 +30,34 @@ def loadLabels(csv_file):
         for row in reader:
             if row:
                 labels.append(row)
-    return labels
\ No newline at end of file
+    return labels
+
+
+def mergeTexts(old_texts, new_texts):
+    # 返回需要重新编码的文本，以及新标签在 [旧特征; 新编码的特征] 中对应的行号
+    rows = {text: i for i, text in enumerate(old_texts)}
+    missing = []
+    for text in new_texts:
+        if text not in rows:
+            rows[text] = len(old_texts) + len(missing)
+            missing.append(text)
+    return missing, [rows[text] for text in new_texts]
+
+
+# 以下函数在后端(myclip.clip3等模块)的label_lock内读取并更新标签，多个线程同时修改也不会丢失更新
+def addLabels(backend, rows):
+    with backend.label_lock:
+        backend.updateLabels(backend.labels + list(rows))
+
+
+def removeLabels(backend, idxs):
+    with backend.label_lock:
+        idxs = set(idxs)
+        backend.updateLabels([x for i, x in enumerate(backend.labels) if i not in idxs])
+
+
+def renameLabel(backend, idx, row):
+    with backend.label_lock:
+        new_labels = list(backend.labels)
+        new_labels[idx] = row
+        backend.updateLabels(new_labels)
@@ -1,39 +1,248 @@
-from PIL import Image
+import time
+import queue
+import threading
+import importlib
 import cv2
 
-import myclip.clip3trt as myclip
+from myclip import metrics
 from myclip.utils import *
 
 
+BACKEND = "myclip.clip3trt"
 SOURCE = 0
 LABEL_CSV = "./labels/2022.csv"
+PIPELINE = True # 采集、预处理、推理分别在独立的线程中流水线执行
+MOTION_THRESHOLD = 3.0 # 缩小后的灰度图平均每像素的变化低于该值时复用上一次的结果，None表示每帧都推理
+MAX_STALE = 30 # 最多连续复用多少帧的结果
+METRICS = True # 统计各阶段的延迟分布，退出时输出
+# 多区域模式: 每层切成(行数, 列数)个区域，所有区域作为一个batch推理，例如((1, 1), (2, 2))；None表示整帧作为一张图
+TILES = None
+TILE_OVERLAP = 0.2 # 相邻区域重叠的比例
+TILE_K = 1 # 每个区域的结果数
+TILE_MIN_PROB = 0.5 # 只显示最高概率不低于该值的区域
+
+myclip = None # 后端在后台线程中导入并加载
+tile_transform = None
 
 
 def main():
+    metrics.enabled = METRICS
     labels = loadLabels(LABEL_CSV)
 
-    myclip.setup(labels)
+    # 导入后端（torch、TensorRT等）和加载模型在后台进行，同时打开摄像头
+    loader = threading.Thread(target=loadBackend, args=(labels,))
+    loader.start()
 
     cap = cv2.VideoCapture(SOURCE)
-    
+    loader.join()
+    if myclip is None:
+        raise RuntimeError(f"Failed to load the backend {BACKEND}.")
+    if TILES:
+        global tile_transform
+        # 依赖torch，在后端载入后才导入，不拖慢启动
+        from myclip.transform import TileTransform
+        # 和后端的preprocess_frame使用相同的分辨率、缩放方式和设备
+        frame_transform = myclip.preprocess_frame
+        tile_transform = TileTransform(frame_transform.resolution, TILES, TILE_OVERLAP, frame_transform.crop,
+                                       frame_transform.outs[0].device)
+
+    if PIPELINE:
+        runPipeline(cap)
+    else:
+        runSerial(cap)
+
+    cap.release() # 释放摄像头资源
+    cv2.destroyAllWindows() # 关闭所有窗口
+
+    if METRICS:
+        print("")
+        print(metrics.report())
+
+
+def loadBackend(labels):
+    global myclip
+    t = time.perf_counter()
+    backend = importlib.import_module(BACKEND)
+    backend.setup(labels)
+    myclip = backend
+    print(f">>> Backend {BACKEND} is loaded in {time.perf_counter() - t:.2f}s")
+
+
+def showResult(max_i, max_p, labels):
+    # labels是预测时使用的标签，运行中增删标签后下标仍然对应
+    category, cn_name = labels[max_i][0:2]
+
+    buff = f"\r[{getFPS():2.0f}fps]\t{max_p*100:3.0f}%\t{category}\t{cn_name}"
+    buff += " " * 20
+    print(buff, end='')
+
+
+def predictTiles(frame):
+    # 一次前向得到每个区域的top-k: ([(区域坐标, 下标列表, 概率列表)], 预测时使用的标签)
+    with metrics.timer('frame_preprocess'):
+        images, boxes = tile_transform(frame)
+    max_i, max_p, labels = myclip.predict_batch(images, TILE_K, return_labels=True)
+    return list(zip(boxes, max_i, max_p)), labels
+
+
+def showTiles(frame, regions, labels):
+    # 画出最高概率不低于TILE_MIN_PROB的区域，编号和输出的结果对应；OpenCV不能绘制中文，标签只在终端输出
+    frame = frame.copy()
+    shown = sorted((r for r in regions if r[2][0] >= TILE_MIN_PROB), key=lambda r: -r[2][0])
+    buff = f"\r[{getFPS():2.0f}fps]"
+    for n, (box, idxs, probs) in enumerate(shown):
+        left, top, right, bottom = (int(round(v)) for v in box)
+        cv2.rectangle(frame, (left, top), (right - 1, bottom - 1), (0, 255, 0), 2)
+        cv2.putText(frame, str(n), (left + 4, top + 24), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (0, 255, 0), 2)
+        buff += "\t#{} {}".format(n, " ".join(f"{p*100:.0f}%{labels[i][1]}" for i, p in zip(idxs, probs)))
+    cv2.imshow('Camera', frame)
+    print(buff + " " * 20, end='')
+
+
+def showFrame(frame, result):
+    # result: 整帧模式为(下标, 概率, 标签)，多区域模式为predictTiles的结果
+    if TILES:
+        showTiles(frame, *result)
+    else:
+        cv2.imshow('Camera', frame)
+        showResult(*result)
+
+
+class MotionGate(object):
+    # 在缩小的灰度图上估计画面变化，画面基本不变时跳过推理
+    def __init__(self, threshold, max_stale, size=32):
+        self.threshold = threshold
+        self.max_stale = max_stale
+        self.size = size
+        self.last = None # 上一次推理的帧的缩略图
+        self.stale = 0 # 已经连续复用的帧数
+
+    def changed(self, frame):
+        if self.threshold is None:
+            return True
+        small = cv2.resize(frame, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # 和上一次推理的帧比较，而不是和上一帧比较，缓慢的变化也能累积到阈值
+        if self.last is None or self.stale >= self.max_stale or cv2.absdiff(small, self.last).mean() > self.threshold:
+            self.last = small
+            self.stale = 0
+            return True
+        self.stale += 1
+        return False
+
+
+def runSerial(cap):
+    gate = MotionGate(MOTION_THRESHOLD, MAX_STALE)
     while True:
         ret, frame = cap.read()
         if ret:
-            cv2.imshow('Camera', frame)
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            max_i, max_p = myclip.predict(img)
-            category, cn_name = labels[max_i][0:2]
-
-            buff = f"\r[{getFPS():2.0f}fps]\t{max_p*100:3.0f}%\t{category}\t{cn_name}"
-            buff += " " * 20
-            print(buff, end='')
-        
+            t = time.perf_counter()
+            if gate.changed(frame):
+                if TILES:
+                    result = predictTiles(frame)
+                else:
+                    max_i, max_p, labels = myclip.predict_batch(myclip.preprocess_frame(frame), return_labels=True)
+                    result = (max_i[0][0], max_p[0][0], labels)
+            showFrame(frame, result)
+            metrics.record('frame', (time.perf_counter() - t) * 1000)
+
         # 等待用户按下ESC键退出
         if cv2.waitKey(1) == 27:
             break
 
-    cap.release() # 释放摄像头资源
-    cv2.destroyAllWindows() # 关闭所有窗口
+
+def putLatest(q, item):
+    # 队列满时丢弃最旧的一项，下游拿到的总是最新的帧，返回被丢弃的项
+    dropped = None
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+def runPipeline(cap):
+    stop = threading.Event()
+    frame_q = queue.Queue(maxsize=1) # 采集 -> 预处理
+    image_q = queue.Queue(maxsize=1) # 预处理 -> 推理
+    result_q = queue.Queue(maxsize=1) # 推理 -> 显示
+    # 空闲的输入缓冲区，预处理写入一个，推理用完或帧被丢弃后归还
+    free_q = queue.Queue()
+    for out in myclip.preprocess_frame.outs:
+        free_q.put(out)
+    gate = MotionGate(MOTION_THRESHOLD, MAX_STALE)
+    last_result = [] # 最近一次推理的结果
+
+    def capture():
+        while not stop.is_set():
+            ret, frame = cap.read()
+            if ret:
+                putLatest(frame_q, (time.perf_counter(), frame))
+
+    def preprocess():
+        while not stop.is_set():
+            try:
+                t, frame = frame_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            # 画面没有明显变化时不推理，直接复用上一次的结果
+            if not gate.changed(frame) and last_result:
+                putLatest(result_q, (t, frame, last_result[-1]))
+                continue
+            if TILES:
+                # 区域的输入张量每帧新建，不使用free_q中的缓冲区
+                with metrics.timer('frame_preprocess'):
+                    images, boxes = tile_transform(frame)
+                putLatest(image_q, (t, frame, (images, boxes)))
+                continue
+            with metrics.timer('frame_preprocess'):
+                image = myclip.preprocess_frame(frame, free_q.get())
+            dropped = putLatest(image_q, (t, frame, image))
+            if dropped is not None:
+                free_q.put(dropped[2])
+
+    def infer():
+        while not stop.is_set():
+            try:
+                t, frame, image = image_q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if TILES:
+                images, boxes = image
+                max_i, max_p, labels = myclip.predict_batch(images, TILE_K, return_labels=True)
+                result = (list(zip(boxes, max_i, max_p)), labels)
+            else:
+                max_i, max_p, labels = myclip.predict_batch(image, return_labels=True)
+                free_q.put(image)
+                result = (max_i[0][0], max_p[0][0], labels)
+            last_result[:] = [result]
+            putLatest(result_q, (t, frame, result))
+
+    threads = [threading.Thread(target=f, daemon=True) for f in (capture, preprocess, infer)]
+    for t in threads:
+        t.start()
+
+    # 显示必须在主线程，显示的画面和结果总是对应同一帧
+    while True:
+        try:
+            t, frame, result = result_q.get(timeout=0.1)
+            showFrame(frame, result)
+            # 从采集到显示结果的延迟
+            metrics.record('frame', (time.perf_counter() - t) * 1000)
+        except queue.Empty:
+            pass
+
+        # 等待用户按下ESC键退出
+        if cv2.waitKey(1) == 27:
+            break
+
+    stop.set()
+    for t in threads:
+        t.join()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Local asyncio HTTP inference server. A myclip backend is loaded once, concurrent requests are coalesced into batches.
+
+    curl --data-binary @./demo/pokemon.jpeg "http://127.0.0.1:8000/predict?k=3"
+"""
+
+import io
+import json
+import time
+import asyncio
+import argparse
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import torch
+
+from myclip.pool import WorkerPool
+from myclip.utils import loadLabels, openImage
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backend", default="clip3trt", choices=["clip1", "clip3", "clip3ort", "clip3trt"])
+    parser.add_argument("--label-csv", default="./labels/2022.csv", type=str)
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--max-batch-size", default=16, type=int, help="Maximum number of images in one forward.")
+    parser.add_argument("--max-wait-ms", default=5, type=float,
+                        help="How long the first request of a batch waits for more requests to arrive.")
+    parser.add_argument("--decode-workers", default=4, type=int, help="Threads decoding and preprocessing uploads.")
+    parser.add_argument("--workers", default=0, type=int,
+                        help="Inference processes sharing the model weights, each pinned to its share of the CPU cores. "
+                             "0 runs the model in the server process. PyTorch CPU backends only (clip1, clip3 on CPU), "
+                             "clip3ort can't share its weights between processes and uses intra-op threads instead.")
+    parser.add_argument("--max-body-size", default=20 * 1024 * 1024, type=int)
+    args = parser.parse_args()
+    return args
+
+
+class MicroBatcher(object):
+    # 把并发的请求合并成一个batch，凑满max_batch_size或者等待超过max_wait_ms后执行一次前向
+    # concurrency是同时执行的batch数，backend为WorkerPool时等于进程数
+    def __init__(self, backend, max_batch_size, max_wait_ms, concurrency=1):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        # 模型只有一份时，推理在单独的一个线程中串行执行
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.slots = asyncio.Semaphore(concurrency)
+        self.tasks = set()
+
+    async def predict(self, image, k):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image, k, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # 有空闲的执行槽位时才开始凑下一个batch
+            await self.slots.acquire()
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self.forward(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def predictItems(self, items):
+        images = torch.stack([image for image, _, _ in items])
+        k = max(k for _, k, _ in items)
+        return self.backend.predict_batch(images, k, return_labels=True)
+
+    def forwardItems(self, items):
+        # 在执行线程中运行，返回每个请求的结果或异常
+        try:
+            max_i, max_p, labels = self.predictItems(items)
+            return [(idxs[:k], probs[:k], labels) for (_, k, _), idxs, probs in zip(items, max_i, max_p)]
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+        # 整个batch失败时逐个重新执行，只有出错的请求返回异常，不影响同一batch中的其他请求
+        return [self.forwardItems([item])[0] for item in items]
+
+    async def forward(self, items):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, self.forwardItems, items)
+        except Exception as e:
+            results = [e] * len(items)
+        finally:
+            self.slots.release()
+        for (_, _, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class Server(object):
+    def __init__(self, backend, args, workers=None):
+        self.backend = backend
+        self.args = args
+        if workers is not None:
+            self.batcher = MicroBatcher(workers, args.max_batch_size, args.max_wait_ms, workers.workers)
+        else:
+            self.batcher = MicroBatcher(backend, args.max_batch_size, args.max_wait_ms)
+        self.decode_executor = ThreadPoolExecutor(args.decode_workers)
+
+    def decode(self, body):
+        return self.backend.preprocess(openImage(io.BytesIO(body), self.backend.preprocess_frame.resolution))
+
+    async def handle(self, reader, writer):
+        try:
+            status, result = await self.route(reader)
+        except Exception as e:
+            status, result = 500, {"error": str(e)}
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: application/json; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def route(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+            return 400, {"error": "bad request"}
+        method, target, _ = request_line
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1')
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        if method == "GET" and url.path == "/health":
+            return 200, {"status": "ok"}
+        if method != "POST" or url.path != "/predict":
+            return 404, {"error": f"unknown endpoint {method} {url.path}"}
+
+        length = int(headers.get("content-length", 0))
+        if length <= 0 or length > self.args.max_body_size:
+            return 400, {"error": "an image body with Content-Length is required"}
+        body = await reader.readexactly(length)
+        # 同一batch中的请求共用一次前向，非法的k在进入队列前拒绝
+        try:
+            k = int(parse_qs(url.query).get("k", ["1"])[0])
+        except ValueError:
+            return 400, {"error": "k must be an integer"}
+        num_labels = len(self.backend.labels)
+        if not 1 <= k <= num_labels:
+            return 400, {"error": f"k must be between 1 and {num_labels}"}
+
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        try:
+            image = await loop.run_in_executor(self.decode_executor, self.decode, body)
+        except Exception as e:
+            return 400, {"error": f"cannot decode image: {e}"}
+        # labels是这次预测使用的标签，期间修改标签不会让下标对应到错误的名称
+        idxs, probs, labels = await self.batcher.predict(image, k)
+
+        return 200, {
+            "results": [{"index": i, "category": labels[i][0], "name": labels[i][1], "prob": p}
+                        for i, p in zip(idxs, probs)],
+            "latency_ms": (time.perf_counter() - start) * 1000,
+        }
+
+    async def serve(self):
+        batcher_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, self.args.host, self.args.port)
+        print(f">>> Serving on http://{self.args.host}:{self.args.port}/predict")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # Log params.
+    print("Params:")
+    for name in sorted(vars(args)):
+        val = getattr(args, name)
+        print(f"  {name}: {val}")
+
+    backend = importlib.import_module(f"myclip.{args.backend}")
+    backend.setup(loadLabels(args.label_csv))
+    # 在创建任何线程之前fork推理进程
+    workers = WorkerPool(backend, args.workers) if args.workers > 0 else None
+
+    asyncio.run(Server(backend, args, workers).serve())
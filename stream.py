@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Headless streaming classification of video files, image globs and directories, results are written as JSONL.
+
+    python stream.py ./recordings/*.mp4 ./datasets/garbage2 --output results.jsonl --k 3
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import argparse
+import threading
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import torch
+
+from myclip.utils import loadLabels, openImage
+
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".webp", ".gif", ".tif", ".tiff"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inputs", nargs="+",
+                        help="Video files (or any source cv2.VideoCapture accepts), image files, globs or directories.")
+    parser.add_argument("--backend", default="clip3trt", choices=["clip1", "clip3", "clip3ort", "clip3trt"])
+    parser.add_argument("--label-csv", default="./labels/2022.csv", type=str)
+    parser.add_argument("--output", default="-", type=str, help="JSONL file, '-' for stdout.")
+    parser.add_argument("--batch-size", default=32, type=int)
+    parser.add_argument("--k", default=1, type=int, help="Number of labels per frame/image.")
+    parser.add_argument("--frame-step", default=1, type=int, help="Classify every n-th frame of the videos.")
+    parser.add_argument("--read-ahead", default=4, type=int, help="Decoded batches buffered ahead of inference.")
+    parser.add_argument("--decode-workers", default=os.cpu_count(), type=int, help="Threads decoding images.")
+    parser.add_argument("--full-decode", action="store_true",
+                        help="Decode JPEGs at full size instead of the smallest DCT-scaled size above the model input.")
+    args = parser.parse_args()
+    return args
+
+
+def expandInputs(inputs):
+    # 展开为[(kind, path)]，目录和glob按文件名排序，kind为"image"或"video"
+    sources = []
+    for path in inputs:
+        if os.path.isdir(path):
+            names = sorted(os.path.join(root, name) for root, _, files in os.walk(path) for name in files)
+            sources += [("image", p) for p in names if os.path.splitext(p)[1].lower() in IMAGE_EXTS]
+        elif glob.has_magic(path):
+            sources += expandInputs(sorted(glob.glob(path)))
+        elif os.path.splitext(path)[1].lower() in IMAGE_EXTS:
+            sources.append(("image", path))
+        else:
+            sources.append(("video", path))
+    return sources
+
+
+def loadImage(backend, img_path, size):
+    return backend.preprocess(openImage(img_path, size))
+
+
+def readBatches(backend, sources, args, out_q, stop):
+    # 后台读取线程: 图片提交给解码线程池，视频在本线程中逐帧读取和预处理
+    # 每个batch是[(meta, 图片张量或Future, 读取时间)]，不同来源的帧可以在同一个batch中
+    # 结束时放入None，出错时放入异常对象，由推理线程重新抛出
+    pool = ThreadPoolExecutor(args.decode_workers)
+    resolution = backend.preprocess_frame.resolution
+    device = backend.preprocess_frame.outs[0].device
+    end = None
+    size = None if args.full_decode else resolution
+    batch = []
+
+    def put(item):
+        batch.append(item)
+        if len(batch) >= args.batch_size:
+            out_q.put(batch[:])
+            batch.clear()
+
+    try:
+        for kind, path in sources:
+            if stop.is_set():
+                break
+            if kind == "image":
+                put(({"source": path}, pool.submit(loadImage, backend, path, size), time.perf_counter()))
+                continue
+
+            cap = cv2.VideoCapture(path)
+            if not cap.isOpened():
+                print(f"Warning: cannot open {path}", file=sys.stderr)
+                continue
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            frame_idx = 0
+            while not stop.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if frame_idx % args.frame_step == 0:
+                    t = time.perf_counter()
+                    # 每帧使用独立的输出张量（和FrameTransform在同一设备上），不复用FrameTransform的缓冲区
+                    image = backend.preprocess_frame(frame, torch.empty(1, 3, resolution, resolution, device=device))[0]
+                    meta = {"source": path, "frame": frame_idx}
+                    if fps > 0:
+                        meta["time_s"] = round(frame_idx / fps, 3)
+                    put((meta, image, t))
+                frame_idx += 1
+            cap.release()
+
+        if batch:
+            out_q.put(batch)
+    except BaseException as e:
+        end = e
+    finally:
+        # 读取出错时也要通知推理线程结束
+        out_q.put(end)
+        pool.shutdown()
+
+
+def main():
+    args = parse_args()
+
+    # Log params.
+    print("Params:", file=sys.stderr)
+    for name in sorted(vars(args)):
+        val = getattr(args, name)
+        print(f"  {name}: {val}", file=sys.stderr)
+
+    sources = expandInputs(args.inputs)
+    assert sources, f"Error: no image or video in {args.inputs}!"
+
+    backend = importlib.import_module(f"myclip.{args.backend}")
+    backend.setup(loadLabels(args.label_csv))
+    # 视频帧在FrameTransform的设备上预处理，解码的图片在CPU上，合并成batch前移到同一设备
+    device = backend.preprocess_frame.outs[0].device
+
+    # 有界队列，读取最多领先推理read_ahead个batch
+    batch_q = queue.Queue(maxsize=args.read_ahead)
+    stop = threading.Event()
+    reader = threading.Thread(target=readBatches, args=(backend, sources, args, batch_q, stop), daemon=True)
+    reader.start()
+
+    output = sys.stdout if args.output == "-" else open(args.output, 'w', encoding='utf-8')
+    count = 0
+    start = time.perf_counter()
+    try:
+        while True:
+            batch = batch_q.get()
+            if batch is None:
+                break
+            if isinstance(batch, BaseException):
+                raise RuntimeError("Failed to read the inputs") from batch
+
+            # 解码失败的图片单独输出错误，不影响同一batch中的其他图片
+            # 每行写在输入的位置上，输出顺序和输入顺序相同
+            items, lines = [], [None] * len(batch)
+            for pos, (meta, image, t) in enumerate(batch):
+                if not isinstance(image, torch.Tensor):
+                    try:
+                        image = image.result()
+                    except Exception as e:
+                        lines[pos] = json.dumps({**meta, "error": f"{type(e).__name__}: {e}"}, ensure_ascii=False)
+                        continue
+                items.append((pos, meta, image, t))
+
+            if items:
+                images = torch.stack([image.to(device) for _, _, image, _ in items])
+                # 下标在这次预测使用的标签中查找
+                max_i, max_p, labels = backend.predict_batch(images, args.k, return_labels=True)
+                now = time.perf_counter()
+                for (pos, meta, _, t), idxs, probs in zip(items, max_i, max_p):
+                    lines[pos] = json.dumps({
+                        **meta,
+                        "results": [{"index": i, "category": labels[i][0], "name": labels[i][1], "prob": p}
+                                    for i, p in zip(idxs, probs)],
+                        "latency_ms": round((now - t) * 1000, 2),
+                    }, ensure_ascii=False)
+
+            output.write("".join(line + "\n" for line in lines))
+            output.flush()
+            count += len(lines)
+    finally:
+        stop.set()
+        # 让读取线程不会阻塞在已满的队列上
+        while reader.is_alive():
+            try:
+                batch_q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if output is not sys.stdout:
+            output.close()
+
+    seconds = time.perf_counter() - start
+    print(f">>> {count} frames/images in {seconds:.1f}s ({count / seconds:.1f}/s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
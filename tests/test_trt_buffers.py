@@ -0,0 +1,92 @@
+import torch
+
+from convert.trt_buffers import OutputBufferPool, get_binding_idxs, output_results
+
+
+class StubEngine(object):
+    # binding 0: input "image" [N, 3, 4, 4], binding 1: output "features" [N, 8]
+    num_bindings = 2
+    num_optimization_profiles = 1
+
+    def binding_is_input(self, index):
+        return index == 0
+
+    def get_binding_name(self, index):
+        return ["image", "features"][index]
+
+
+class StubContext(object):
+    def __init__(self):
+        self.engine = StubEngine()
+        self.shapes = {}
+        self.set_calls = 0
+
+    def set_binding_shape(self, index, shape):
+        self.shapes[index] = tuple(shape)
+        self.set_calls += 1
+
+    def get_binding_shape(self, binding):
+        return (self.shapes[0][0], 8)
+
+
+def make_pool(max_shapes=8):
+    context = StubContext()
+    input_idxs, output_idxs = get_binding_idxs(context.engine, 0)
+    return context, OutputBufferPool(context, input_idxs, output_idxs, device="cpu", max_shapes=max_shapes)
+
+
+def test_binding_idxs():
+    assert get_binding_idxs(StubEngine(), 0) == ([0], [1])
+
+
+def test_reuse_buffers_per_shape():
+    context, pool = make_pool()
+    outputs, ptrs = pool.get([torch.empty(2, 3, 4, 4)])
+    assert outputs["features"].shape == (2, 8)
+    assert ptrs == [outputs["features"].data_ptr()]
+    assert context.set_calls == 1
+
+    # same shape: same buffers, binding shapes are not set again
+    outputs_again, ptrs_again = pool.get([torch.empty(2, 3, 4, 4)])
+    assert outputs_again["features"] is outputs["features"]
+    assert ptrs_again == ptrs
+    assert context.set_calls == 1
+
+
+def test_reallocate_on_new_shape():
+    context, pool = make_pool()
+    small, _ = pool.get([torch.empty(2, 3, 4, 4)])
+    large, _ = pool.get([torch.empty(5, 3, 4, 4)])
+    assert large["features"].shape == (5, 8)
+    assert large["features"] is not small["features"]
+    assert context.shapes[0] == (5, 3, 4, 4)
+
+    # switching back reuses the first buffers but binds the shape again
+    calls = context.set_calls
+    small_again, _ = pool.get([torch.empty(2, 3, 4, 4)])
+    assert small_again["features"] is small["features"]
+    assert context.set_calls == calls + 1
+    assert context.shapes[0] == (2, 3, 4, 4)
+
+
+def test_evict_least_recently_used_shape():
+    _, pool = make_pool(max_shapes=2)
+    first, _ = pool.get([torch.empty(1, 3, 4, 4)])
+    pool.get([torch.empty(2, 3, 4, 4)])
+    pool.get([torch.empty(3, 3, 4, 4)])
+    assert list(pool.buffers) == [((2, 3, 4, 4),), ((3, 3, 4, 4),)]
+    assert pool.get([torch.empty(1, 3, 4, 4)])[0]["features"] is not first["features"]
+
+
+def test_output_results_views_or_copies():
+    _, pool = make_pool()
+    outputs, _ = pool.get([torch.empty(2, 3, 4, 4)])
+    outputs["features"].fill_(1)
+
+    views = output_results(outputs, reuse_outputs=True)
+    assert views["features"].data_ptr() == outputs["features"].data_ptr()
+
+    copies = output_results(outputs, reuse_outputs=False)
+    assert copies["features"].data_ptr() != outputs["features"].data_ptr()
+    outputs["features"].fill_(2)
+    assert bool((views["features"] == 2).all()) and bool((copies["features"] == 1).all())
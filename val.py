@@ -1,52 +1,247 @@
-import os, random
-from PIL import Image
+import os, time, random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
 
 import myclip.clip3trt as myclip
+from myclip import metrics
+from myclip.cache import ImageStore
+from myclip.pool import WorkerPool
 from myclip.utils import *
 
 
-NUM = 1000
+NUM = 1000 # 评测的图片数量，None表示评测整个数据集
+SEED = 0 # 抽样的随机种子，相同的种子每次抽到相同的图片
+BATCH_SIZE = 32 # 每次推理的图片数
+WORKERS = os.cpu_count() # 解码和预处理的线程数
+PROCESSES = 0 # 大于1时在多个进程中推理，每个进程绑定一部分CPU核（只支持clip1、clip3的CPU模式）
+METRICS = True # 统计各阶段的延迟分布，结束时输出
+IMAGE_STORE = True # 把图片特征缓存到磁盘，只改标签或提示词时不再重新计算图片特征
+DRAFT_DECODE = True # JPEG直接解码到接近模型输入分辨率的尺寸，不完整解码大图
+QUANTIZE_CHECK = False # 分别用fp32和INT8量化的图像模型评测（clip3、clip3ort），输出准确率变化和加速比
+MAX_ACCURACY_DROP = 1.0 # 量化后precise+correct的比例最多允许下降的百分点
+SPEED_IMAGES = 64 # 量化检查中测速用的图片数，预先解码和预处理，只计时图像模型的前向
+SPEED_ROUNDS = 4 # 测速轮数，每轮交替fp32和int8的先后顺序
 LABEL_CSV = "./labels/val158.csv"
 DATASET_PATH = "./datasets/garbage2"
 
 
-def main():
-    labels = loadLabels(LABEL_CSV)
-    
-    myclip.setup(labels)
+def indexDataset(labels):
+    # 只遍历一次数据集目录，得到所有(类别, 图片路径)
+    samples = []
+    for label in labels:
+        imgs_path = os.path.join(DATASET_PATH, str(label[3])) # 类别的路径
+        for name in sorted(os.listdir(imgs_path)):
+            samples.append((label, os.path.join(imgs_path, name)))
+    return samples
+
+
+def loadImage(img_path):
+    with metrics.timer('decode'):
+        img = openImage(img_path, myclip.preprocess_frame.resolution if DRAFT_DECODE else None)
+    with metrics.timer('image_preprocess'):
+        return myclip.preprocess(img)
+
+
+def loadBatches(pool, img_paths):
+    # 提前提交下一批的解码任务，让解码、预处理和推理重叠执行
+    futures = []
+    for start in range(0, len(img_paths), BATCH_SIZE):
+        next_futures = [pool.submit(loadImage, p) for p in img_paths[start:start + BATCH_SIZE]]
+        if futures:
+            yield torch.stack([f.result() for f in futures])
+        futures = next_futures
+    if futures:
+        yield torch.stack([f.result() for f in futures])
+
+
+def normalizeFeatures(image_features):
+    image_features = torch.as_tensor(image_features).float()
+    image_features /= image_features.norm(dim=1, keepdim=True)
+    return image_features.cpu().numpy()
+
 
+def encodeImages(batches, workers):
+    # 按批返回归一化后的图片特征
+    # encodeImage不会分段，每批按后端单次前向的上限（固定batch的ONNX模型、TensorRT engine的最大batch）切开计算
+    max_batch_size = myclip.imageBatchSize()
+    counts = deque() # 每批切成的段数
+
+    def chunks():
+        for images in batches:
+            parts = [images[start:start + max_batch_size] for start in range(0, len(images), max_batch_size)]
+            counts.append(len(parts))
+            yield from parts
+
+    def encode():
+        for images in chunks():
+            # 归一化时取回CPU，GPU上异步的前向也计入这一阶段
+            with torch.no_grad(), metrics.timer('encode_image'):
+                image_features = normalizeFeatures(myclip.encodeImage(images))
+            yield image_features
+
+    if workers is not None:
+        # 多进程时所有段连续提交，不同批的段也可以同时计算；子进程中的耗时不计入metrics
+        results = (normalizeFeatures(image_features) for image_features in workers.map('encodeImage', chunks()))
+    else:
+        results = encode()
+    parts = []
+    for image_features in results:
+        parts.append(image_features)
+        if len(parts) == counts[0]:
+            counts.popleft()
+            yield np.concatenate(parts)
+            parts = []
+
+
+def predictSamples(pool, img_paths, image_store, workers=None):
+    # 按批返回每张图片的预测结果
+    if not image_store:
+        if workers is not None:
+            yield from workers.map('predict_batch', loadBatches(pool, img_paths))
+            return
+        for images in loadBatches(pool, img_paths):
+            yield myclip.predict_batch(images)
+        return
+
+    # 只计算还没有缓存的图片特征，之后只需要和文本特征做一次矩阵乘法
+    # 缩小解码得到的特征和完整解码的略有差别，分开缓存
+    store = ImageStore(myclip.modelId('image') + (":draft" if DRAFT_DECODE else ""))
+    missing = store.missing(img_paths)
+    for start, image_features in zip(range(0, len(missing), BATCH_SIZE), encodeImages(loadBatches(pool, missing), workers)):
+        store.add(missing[start:start + BATCH_SIZE], image_features)
+
+    for start in range(0, len(img_paths), BATCH_SIZE):
+        image_features = store.get(img_paths[start:start + BATCH_SIZE])
+        with metrics.timer('classify'):
+            result = myclip.predictFeatures(image_features)
+        yield result
+
+
+def evaluate(pool, labels, samples, image_store, workers=None):
+    # 返回(precise, correct, wrong)的数量和耗时(s)
     precise_cnt = 0
     correct_cnt = 0
     wrong_cnt = 0
 
-    for i in range(NUM):
-        category, cn_name, en_name, idx = random.choice(labels) # 随机选择一个类别
-        imgs_path = os.path.join(DATASET_PATH, str(idx)) # 类别的路径
-        img_path = os.path.join(imgs_path, random.choice(os.listdir(imgs_path))) # 随机选择该类别里的一个图片
-        img = Image.open(img_path) # 读入图片
+    i = 0
+    start = time.perf_counter()
+    for max_is, max_ps in predictSamples(pool, [img_path for _, img_path in samples], image_store, workers):
+        fps = getFPS() * len(max_is)
+
+        for max_i, max_p in zip(max_is, max_ps):
+            (category, cn_name, en_name, idx), img_path = samples[i]
+            p_category, p_cn_name, p_en_name, p_idx = labels[max_i[0]]
 
-        max_i, max_p = myclip.predict(img)
-        p_category, p_cn_name, p_en_name, p_idx = labels[max_i]
+            if idx == p_idx:
+                precise_cnt += 1
+                add_output = "precise"
+            elif category == p_category:
+                correct_cnt += 1
+                add_output = "correct"
+            else:
+                wrong_cnt += 1
+                add_output = f"wrong\t{category}({cn_name})\t->\t{p_category}({p_cn_name})\t{img_path}"
 
-        if idx == p_idx:
-            precise_cnt += 1
-            add_output = "precise"
-        elif category == p_category:
-            correct_cnt += 1
-            add_output = "correct"
-        else:
-            wrong_cnt += 1
-            add_output = f"wrong\t{category}({cn_name})\t->\t{p_category}({p_cn_name})\t{img_path}"
+            print(f"\r[{fps:3.0f}fps]\t{i}\t{max_p[0]*100:3.0f}%\t{add_output}")
+            i += 1
 
-        print(f"\r[{getFPS():3.0f}fps]\t{i}\t{max_p*100:3.0f}%\t{add_output}")
+    return (precise_cnt, correct_cnt, wrong_cnt), time.perf_counter() - start
 
+
+def printCounts(counts):
+    precise_cnt, correct_cnt, wrong_cnt = counts
     total = precise_cnt + correct_cnt + wrong_cnt
-    print("")
     print("total:\t%d" % total)
     print("precise:\t%d(%.1f%%)" % (precise_cnt, precise_cnt / total * 100))
     print("correct:\t%d(%.1f%%)" % (correct_cnt, correct_cnt / total * 100))
     print("wrong:\t%d(%.1f%%)" % (wrong_cnt, wrong_cnt / total * 100))
 
 
+def encodeSpeed(models, batches):
+    # 用相同的、已经预处理好的输入分别计时两个图像模型的前向，返回每个模型的总耗时(s)
+    # 先各预热一次，之后每轮交替先后顺序，避免先运行的一方总是承担缓存和频率变化的影响
+    seconds = {key: 0.0 for key in models}
+    for key in models:
+        myclip.model = models[key]
+        with torch.no_grad():
+            myclip.encodeImage(batches[0])
+    for r in range(SPEED_ROUNDS):
+        for key in (list(models) if r % 2 == 0 else list(models)[::-1]):
+            myclip.model = models[key]
+            start = time.perf_counter()
+            with torch.no_grad():
+                for images in batches:
+                    myclip.encodeImage(images)
+            seconds[key] += time.perf_counter() - start
+    return seconds
+
+
+def quantizeCheck(pool, labels, samples):
+    # 不使用图片特征缓存，两次评测都真正计算图片特征
+    assert hasattr(myclip, "quantize"), f"Error: {myclip.__name__} has no quantized mode!"
+    results = {}
+    models = {}
+    for quantize in (False, True):
+        myclip.quantize = quantize
+        myclip.loadModel()
+        models[quantize] = myclip.model
+        results[quantize] = evaluate(pool, labels, samples, image_store=False)
+
+    # 速度只比较图像模型本身，不包括解码和预处理
+    speed_paths = [img_path for _, img_path in samples[:SPEED_IMAGES]]
+    images = torch.stack(list(pool.map(loadImage, speed_paths)))
+    max_batch_size = myclip.imageBatchSize()
+    batches = [images[start:start + max_batch_size] for start in range(0, len(images), max_batch_size)]
+    seconds = encodeSpeed(models, batches)
+    myclip.model = models[myclip.quantize]
+
+    print("")
+    for quantize, (counts, _) in results.items():
+        speed = len(images) * SPEED_ROUNDS / seconds[quantize]
+        print("[%s]\tencode %.1fimg/s" % ("int8" if quantize else "fp32", speed))
+        printCounts(counts)
+
+    fp32_counts, int8_counts = results[False][0], results[True][0]
+    # precise和correct都算作分类正确
+    fp32_acc = (fp32_counts[0] + fp32_counts[1]) / len(samples) * 100
+    int8_acc = (int8_counts[0] + int8_counts[1]) / len(samples) * 100
+    passed = fp32_acc - int8_acc <= MAX_ACCURACY_DROP
+    print("")
+    print("precise delta:\t%+.1f%%" % ((int8_counts[0] - fp32_counts[0]) / len(samples) * 100))
+    print("accuracy delta:\t%+.1f%%\t(%.1f%% -> %.1f%%)" % (int8_acc - fp32_acc, fp32_acc, int8_acc))
+    print("encode speedup:\t%.2fx\t(%d images x %d rounds)" % (seconds[False] / seconds[True], len(images), SPEED_ROUNDS))
+    print("%s: accuracy drop %s %.1f%%" % ("PASS" if passed else "FAIL", "<=" if passed else ">", MAX_ACCURACY_DROP))
+
+
+def main():
+    metrics.enabled = METRICS
+    labels = loadLabels(LABEL_CSV)
+
+    myclip.setup(labels)
+
+    samples = indexDataset(labels)
+    if NUM is not None and NUM < len(samples):
+        samples = random.Random(SEED).sample(samples, NUM) # 可复现的随机抽样
+
+    if QUANTIZE_CHECK:
+        with ThreadPoolExecutor(WORKERS) as pool:
+            quantizeCheck(pool, labels, samples)
+    else:
+        # 在创建解码线程之前fork推理进程
+        workers = WorkerPool(myclip, PROCESSES) if PROCESSES > 1 else None
+        with ThreadPoolExecutor(WORKERS) as pool:
+            counts, _ = evaluate(pool, labels, samples, IMAGE_STORE, workers)
+        if workers is not None:
+            workers.close()
+        print("")
+        printCounts(counts)
+
+    if METRICS:
+        print("")
+        print(metrics.report())
+
+
 if __name__ == "__main__":
     main()